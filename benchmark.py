@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark for the Telegram sender bot.
+Runs the bot against a local stub of the Telegram Bot API, with subscribers kept in memory,
+and hammers its TCP port with concurrent producers. Reports messages per second, end-to-end
+latency (from the producer to the last subscriber) and memory usage.
+
+No Telegram and no PostgreSQL are needed. Example:
+
+    benchmark.py --subscribers 10,1000,100000 --messages 20 --producers 4
+"""
+
+import argparse
+import sys
+import os
+import re
+import json
+import time
+import random
+import socket
+import logging
+import resource
+import tempfile
+import threading
+import socketserver
+import http.server
+
+import sender_bot
+
+__author__ = "Yury D."
+__credits__ = ["Yury D."]
+__license__ = "MIT"
+__version__ = "1.0.0"
+__maintainer__ = "Yury D."
+__email__ = "TheOwlSoul@gmail.com"
+__status__ = "Beta"
+
+
+class StubBotAPIHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler of the stub Bot API, answers sendMessage and getMe like Telegram does.
+    Latency, errors and flood control (429) are injected according to the server settings.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # Benchmark messages look like "bench <seq> <send time>"
+    BENCH_RE = re.compile(r'^bench (\d+) ([0-9.]+)')
+
+    def respond(self, code, data):
+        """
+        Send the JSON response.
+        :param code: HTTP status code
+        :param data: response data
+        :return: nothing
+        """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """
+        Process POST request.
+        :return: nothing
+        """
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        method = self.path.rsplit('/', 1)[-1]
+
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if method == 'getMe':
+            self.respond(200, {'ok': True, 'result': {'id': 1, 'is_bot': True,
+                                                      'first_name': 'stub', 'username': 'stub_bot'}})
+            return
+
+        if method != 'sendMessage':
+            self.respond(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+
+        if random.random() < stub.flood_rate:
+            stub.count('flood')
+            self.respond(429, {'ok': False, 'error_code': 429,
+                               'description': 'Too Many Requests: retry after 1',
+                               'parameters': {'retry_after': 1}})
+            return
+
+        if random.random() < stub.error_rate:
+            stub.count('errors')
+            self.respond(502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'})
+            return
+
+        try:
+            params = json.loads(body.decode('utf-8'))
+        except ValueError:
+            params = dict(pair.split('=', 1) for pair in body.decode('utf-8').split('&') if '=' in pair)
+        text = str(params.get('text', ''))
+        stub.delivered(text)
+
+        self.respond(200, {'ok': True, 'result': {'message_id': 1,
+                                                  'date': int(time.time()),
+                                                  'chat': {'id': int(params.get('chat_id', 0)),
+                                                           'type': 'private'},
+                                                  'text': text}})
+
+    def log_message(self, format, *args):
+        """
+        Silence the request log.
+        :return: nothing
+        """
+        #pylint:disable=W0622
+        pass
+
+
+class StubBotAPIServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Stub Bot API HTTP server, one thread per connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stub, address):
+        self.stub = stub
+        super().__init__(address, StubBotAPIHandler)
+
+
+class StubBotAPI:
+    """
+    Stub of the Telegram Bot API, records deliveries of the benchmark messages.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, flood_rate=0.0):
+        # Seconds to wait before every answer, share of 502 errors and of 429 errors
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+
+        self.lock = threading.Lock()
+        self.counters = {'sends': 0, 'errors': 0, 'flood': 0}
+
+        # seq -> [send time, deliveries, last delivery time]
+        self.messages = {}
+
+        self.server = None
+        self.thread = None
+
+    def count(self, name):
+        """
+        Increase the counter.
+        :param name: counter name
+        :return: nothing
+        """
+        with self.lock:
+            self.counters[name] += 1
+
+    def delivered(self, text):
+        """
+        Record the delivery of the message.
+        :param text: message text
+        :return: nothing
+        """
+        now = time.time()
+        match = StubBotAPIHandler.BENCH_RE.match(text)
+        with self.lock:
+            self.counters['sends'] += 1
+            if match:
+                entry = self.messages.setdefault(int(match.group(1)), [float(match.group(2)), 0, 0])
+                entry[1] += 1
+                entry[2] = now
+
+    def reset(self):
+        """
+        Forget all recorded deliveries.
+        :return: nothing
+        """
+        with self.lock:
+            self.counters = {'sends': 0, 'errors': 0, 'flood': 0}
+            self.messages = {}
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Start the server in the background.
+        :param host: host to listen on
+        :param port: port to listen on, 0 for any free port
+        :return: base URL for the Updater
+        """
+        self.server = StubBotAPIServer(self, (host, port))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return 'http://' + host + ':' + str(self.server.server_address[1]) + '/bot'
+
+    def stop(self):
+        """
+        Stop the server.
+        :return: nothing
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Benchmark:
+    """
+    Benchmark runner.
+    """
+    def __init__(self):
+        self.subscribers = [10, 1000]
+        self.messages = 20
+        self.producers = 4
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.flood_rate = 0.0
+        self.send_workers = 32
+        self.global_rate = 1000000.0
+        self.timeout = 600.0
+        self.port = 0
+
+    @staticmethod
+    def free_port():
+        """
+        Find a free TCP port.
+        :return: port number
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    @staticmethod
+    def memory_mb():
+        """
+        Current resident memory of the process.
+        :return: megabytes
+        """
+        try:
+            with open('/proc/self/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def percentile(values, share):
+        """
+        Percentile of the values.
+        :param values: list of numbers
+        :param share: percentile, 0..1
+        :return: value, 0 if there are no values
+        """
+        if not values:
+            return 0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(share * len(values)))]
+
+    def produce(self, port, sequence):
+        """
+        Producer: send the messages to the bot, one connection per message.
+        :param port: bot TCP port
+        :param sequence: numbers of the messages to send
+        :return: nothing
+        """
+        for seq in sequence:
+            conn = socket.create_connection(('127.0.0.1', port))
+            conn.sendall(("bench " + str(seq) + " " + repr(time.time())).encode('utf-8'))
+            conn.shutdown(socket.SHUT_WR)
+            conn.recv(1024)
+            conn.close()
+
+    def run_one(self, stub, base_url, subscribers):
+        """
+        Run the benchmark for the number of subscribers.
+        :param stub: stub Bot API
+        :param base_url: stub Bot API base URL
+        :param subscribers: number of subscribers
+        :return: dict with results
+        """
+        stub.reset()
+        spool_dir = tempfile.mkdtemp(prefix='sender_bench_')
+
+        app = sender_bot.Application()
+        app.token = '123456:benchmark'
+        app.port = self.port or self.free_port()
+        app.spool_path = os.path.join(spool_dir, 'spool.db')
+        app.documents_path = os.path.join(spool_dir, 'documents')
+        app.send_workers = self.send_workers
+        app.global_rate = self.global_rate
+        app.max_queue = self.messages + 1
+        app.subscribers = sender_bot.SubscriberRegistry(str(i) for i in range(1, subscribers + 1))
+        # Per chat limits would make the run last messages x seconds, they are not benchmarked
+        sender_bot.RateLimiter.CHAT_RATE = self.global_rate
+        sender_bot.RateLimiter.GROUP_RATE = self.global_rate
+        app.setup_bot(base_url=base_url)
+        app.start_threads()
+        time.sleep(0.5)
+
+        memory_before = self.memory_mb()
+        start_time = time.time()
+        producers = []
+        for i in range(self.producers):
+            producer = threading.Thread(target=self.produce,
+                                        args=(app.port, range(i, self.messages, self.producers)))
+            producer.start()
+            producers.append(producer)
+        for producer in producers:
+            producer.join()
+        ingest_time = time.time() - start_time
+
+        expected = self.messages * subscribers
+        while time.time() - start_time < self.timeout:
+            with stub.lock:
+                done = sum(entry[1] for entry in stub.messages.values())
+            if done >= expected:
+                break
+            time.sleep(0.05)
+        elapsed = time.time() - start_time
+        memory_after = self.memory_mb()
+
+        app.is_running = False
+        app.join_threads()
+
+        with stub.lock:
+            latencies = [entry[2] - entry[0] for entry in stub.messages.values()
+                         if entry[1] >= subscribers]
+            delivered = sum(entry[1] for entry in stub.messages.values())
+            counters = dict(stub.counters)
+
+        return {'subscribers': subscribers,
+                'messages': self.messages,
+                'delivered': delivered,
+                'expected': expected,
+                'ingest_per_s': self.messages / ingest_time if ingest_time else 0,
+                'sends_per_s': delivered / elapsed if elapsed else 0,
+                'p50': self.percentile(latencies, 0.5),
+                'p99': self.percentile(latencies, 0.99),
+                'errors': counters['errors'],
+                'flood': counters['flood'],
+                'memory_mb': memory_after,
+                'memory_delta_mb': memory_after - memory_before}
+
+    def parse_arguments(self):
+        """
+        Parse CLI arguments.
+        :return: nothing
+        """
+        #pylint:disable=C0301
+        parser = argparse.ArgumentParser(description="Offline benchmark of the Telegram sender bot, using a stub "
+                                                     "Bot API and synthetic producers.",
+                                         formatter_class=argparse.RawTextHelpFormatter)
+        parser.add_argument("--subscribers", metavar="N,N,...", default="10,1000",
+                            help="numbers of subscribers to benchmark, default is 10,1000")
+        parser.add_argument("--messages", metavar="N", default=self.messages,
+                            help="messages to send per run, default is " + str(self.messages))
+        parser.add_argument("--producers", metavar="N", default=self.producers,
+                            help="concurrent producers, default is " + str(self.producers))
+        parser.add_argument("--latency", metavar="SEC", default=self.latency,
+                            help="stub API latency, default is " + str(self.latency))
+        parser.add_argument("--error_rate", metavar="SHARE", default=self.error_rate,
+                            help="share of sends failing with 502, default is " + str(self.error_rate))
+        parser.add_argument("--flood_rate", metavar="SHARE", default=self.flood_rate,
+                            help="share of sends failing with 429, default is " + str(self.flood_rate))
+        parser.add_argument("--send_workers", metavar="N", default=self.send_workers,
+                            help="parallel sends of the bot, default is " + str(self.send_workers))
+        parser.add_argument("--global_rate", metavar="RATE", default=self.global_rate,
+                            help="bot rate limit, messages per second, default is " + str(self.global_rate))
+        parser.add_argument("--timeout", metavar="SEC", default=self.timeout,
+                            help="maximum duration of one run, default is " + str(self.timeout))
+        parser.add_argument("--verbose", action="store_true", default=False,
+                            help="show the bot log")
+        #pylint:enable=C0301
+
+        args = parser.parse_args()
+        self.subscribers = [int(value) for value in args.subscribers.split(',') if value.strip()]
+        self.messages = int(args.messages)
+        self.producers = int(args.producers)
+        self.latency = float(args.latency)
+        self.error_rate = float(args.error_rate)
+        self.flood_rate = float(args.flood_rate)
+        self.send_workers = int(args.send_workers)
+        self.global_rate = float(args.global_rate)
+        self.timeout = float(args.timeout)
+
+        logging.basicConfig(format='[%(asctime)s] %(name)s : %(levelname)s : %(message)s',
+                            level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    def run(self):
+        """
+        Run the benchmark for every number of subscribers and print the report.
+        :return: 0 if all messages were delivered, 1 if not
+        """
+        self.parse_arguments()
+
+        # The stub is local, proxies must not be used
+        for name in ('HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy'):
+            os.environ.pop(name, None)
+
+        stub = StubBotAPI(self.latency, self.error_rate, self.flood_rate)
+        base_url = stub.start()
+
+        print("%12s %9s %12s %12s %10s %10s %8s %8s %10s" %
+              ("subscribers", "messages", "ingest/s", "sends/s", "p50, s", "p99, s",
+               "502s", "429s", "RSS, MB"))
+        result = 0
+        for subscribers in self.subscribers:
+            report = self.run_one(stub, base_url, subscribers)
+            print("%12d %9d %12.1f %12.1f %10.3f %10.3f %8d %8d %10.1f" %
+                  (report['subscribers'], report['messages'], report['ingest_per_s'],
+                   report['sends_per_s'], report['p50'], report['p99'], report['errors'],
+                   report['flood'], report['memory_mb']))
+            if report['delivered'] < report['expected']:
+                print("  only %d of %d sends delivered" % (report['delivered'], report['expected']))
+                result = 1
+
+        stub.stop()
+        return result
+
+
+if __name__ == '__main__':
+    sys.exit(Benchmark().run())
@@ -5,7 +5,7 @@ Telegram sender bot, it will receive a message on socket and will broadcast it t
 Each subscriber needs to register first, using command "/register:SecretWord", the SecretWord
 is chosen by the bot owner.
 
-Requires PostgreSQL database to work.
+Subscribers are kept in PostgreSQL database, or in SQLite database for small installations.
 """
 
 import argparse
@@ -14,13 +14,34 @@ import signal
 import logging
 import threading
 import time
-import socket
 import socketserver
-import psycopg2
+import socket
+import concurrent.futures
+import random
+import sqlite3
+import json
+import hashlib
+import collections
+import http.server
+import select
+import zlib
+import re
+import os
+import tempfile
+import weakref
 from telegram.ext import Updater
 from telegram.ext import CommandHandler
+from telegram.error import NetworkError, BadRequest, RetryAfter, Unauthorized
 from telegram import __version__ as TELEGRAM_API_VERSION
 
+# PostgreSQL is optional, small installations may keep subscribers in SQLite
+try:
+    import psycopg2
+    import psycopg2.pool
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
 __author__ = "Yury D."
 __credits__ = ["Yury D."]
 __license__ = "MIT"
@@ -29,65 +50,3162 @@ __maintainer__ = "Yury D."
 __email__ = "TheOwlSoul@gmail.com"
 __status__ = "Beta"
 
+# Maximum length of the Telegram text message
+MESSAGE_LIMIT = 4096
+
+# Maximum length of the caption of the Telegram document
+CAPTION_LIMIT = 1024
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Split the text into parts fitting into one Telegram message, breaking on line ends if possible.
+    :param text: text to split
+    :param limit: maximum length of the part
+    :return: list of parts
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+def make_preview(text, size, limit=CAPTION_LIMIT):
+    """
+    Make the preview of the long message sent as a document: its first lines, and the size of the whole.
+    :param text: message text, or its beginning
+    :param size: size of the whole message in bytes
+    :param limit: maximum length of the preview
+    :return: preview text
+    """
+    note = "[" + str(size) + " bytes, full message attached]"
+    text = text.strip()
+    head = text[:limit - len(note) - 2]
+    cut = head.rfind("\n")
+    if len(head) < len(text) and cut > 0:
+        head = head[:cut]
+    return head.rstrip() + "\n\n" + note if head.strip() else note
+
+
+class Metrics:
+    """
+    Minimal metrics registry: counters, gauges and histograms, exported in Prometheus text format.
+    Thread safe.
+    """
+    # Metric descriptions: name -> (type, help)
+    DESCRIPTIONS = {
+        'sender_messages_ingested_total': ('counter', "Messages accepted for the broadcast, by source and priority."),
+        'sender_messages_rejected_total': ('counter', "Messages rejected on ingest, by reason."),
+        'sender_messages_delivered_total': ('counter', "Messages fully delivered to all recipients."),
+        'sender_messages_expired_total': ('counter', "Messages dropped from the spool after their TTL."),
+        'sender_delivery_seconds': ('histogram', "Time from receiving the message to the last delivery."),
+        'sender_send_seconds': ('histogram', "Latency of a single Telegram API call."),
+        'sender_sends_total': ('counter', "Telegram sends, by result."),
+        'sender_retries_total': ('counter', "Retries of Telegram calls after network errors."),
+        'sender_flood_control_total': ('counter', "Flood control (429) responses from Telegram."),
+        'sender_send_failures_total': ('counter', "Failed sends, by chat."),
+        'sender_duplicates_suppressed_total': ('counter', "Repeated messages suppressed."),
+        'sender_duplicate_summaries_total': ('counter', "Summaries sent for suppressed repeats."),
+        'sender_dedup_keys': ('gauge', "Messages remembered for suppression of repeats."),
+        'sender_spool_messages': ('gauge', "Undelivered messages in the spool."),
+        'sender_coalescer_messages': ('gauge', "Messages waiting in the coalescer."),
+        'sender_subscribers': ('gauge', "Registered subscribers."),
+        'sender_subscribers_quarantined': ('gauge', "Subscribers skipped as unreachable."),
+        'sender_documents_uploaded_total': ('counter', "Long messages uploaded as documents."),
+        'sender_chats_quarantined_total': ('counter', "Chats quarantined after being unreachable."),
+        'sender_sync_changes_total': ('counter', "Subscriber changes applied from the database, by source."),
+        'sender_db_connections_in_use': ('gauge', "Database connections taken from the pool."),
+        'sender_connections_active': ('gauge', "Producer connections being handled, by port."),
+    }
+
+    # Histogram buckets, seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # (name, labels) -> value
+        self.values = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+        # name -> function returning the value, evaluated on export
+        self.functions = {}
+
+    @staticmethod
+    def labels_key(labels):
+        """
+        Make the hashable key of the labels.
+        :param labels: labels dict
+        :return: sorted tuple of (name, value)
+        """
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase the counter, or change the gauge by value.
+        :param name: metric name
+        :param value: increment, may be negative for gauges
+        :param labels: metric labels
+        :return: nothing
+        """
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Record the value in the histogram.
+        :param name: metric name
+        :param value: observed value
+        :param labels: metric labels
+        :return: nothing
+        """
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self.BUCKETS), 0.0, 0]
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, function):
+        """
+        Register the gauge, its value is taken from the function on export.
+        :param name: metric name
+        :param function: function returning the value
+        :return: nothing
+        """
+        self.functions[name] = function
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        """
+        Format the labels for the exposition.
+        :param labels: tuple of (name, value)
+        :param extra: additional (name, value) pairs
+        :return: formatted labels, empty string if there are none
+        """
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(name + '="' + value.replace("\\", "\\\\").replace('"', '\\"')
+                              .replace("\n", "\\n") + '"'
+                              for name, value in pairs) + "}"
+
+    def export(self):
+        """
+        Export all metrics in Prometheus text format.
+        :return: text
+        """
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append(name + self.format_labels(labels) + " " + str(value))
+            for (name, labels), (buckets, total, count) in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    lines.append(name + "_bucket" + self.format_labels(labels, [('le', str(bound))]) +
+                                 " " + str(bucket))
+                lines.append(name + "_bucket" + self.format_labels(labels, [('le', '+Inf')]) +
+                             " " + str(count))
+                lines.append(name + "_sum" + self.format_labels(labels) + " " + str(total))
+                lines.append(name + "_count" + self.format_labels(labels) + " " + str(count))
+        for name, function in list(self.functions.items()):
+            try:
+                samples[name] = [name + " " + str(function())]
+            except Exception as e:
+                logging.debug("Exception (metrics gauge %s): %s", name, str(e))
+
+        result = []
+        for name in sorted(samples):
+            kind, text = self.DESCRIPTIONS.get(name, ('untyped', name))
+            result.append("# HELP " + name + " " + text)
+            result.append("# TYPE " + name + " " + kind)
+            result.extend(samples[name])
+        return "\n".join(result) + "\n"
+
+
+# Metrics of the bot, shared by all components
+METRICS = Metrics()
+
 
 class MyTCPRequestHandler(socketserver.StreamRequestHandler):
     """
     Handler for TCP request handler.
+    Long payloads are streamed to the document spool and sent as documents.
     """
+    def setup(self):
+        """
+        Set up the connection, applying the read timeout.
+        :return: nothing
+        """
+        self.timeout = self.server.app.read_timeout
+        super().setup()
+
+    def respond(self, text):
+        """
+        Send the response to the client. Clients usually do not read it, so errors are ignored.
+        :param text: response text
+        :return: nothing
+        """
+        try:
+            self.wfile.write((text + "\n").encode('utf-8'))
+        except Exception as e:
+            logging.debug("Failed to respond to %s: %s", self.client_address[0], str(e))
+
+    # Header lines the message may start with. The marker keeps plain messages which happen
+    # to start with "Priority:" or "Topic:" from being taken for headers
+    HEADER_MARKER = '@'
+    HEADERS = ('priority', 'topic')
+
+    def parse_header(self, line):
+        """
+        Parse the header line "@PRIORITY: name" or "@TOPIC: name".
+        :param line: line of the message, bytes
+        :return: tuple (name, value), None if the line is not a valid header
+        """
+        line = line.decode('utf-8', 'replace').strip()
+        if not line.startswith(self.HEADER_MARKER):
+            return None
+        name, colon, value = line[len(self.HEADER_MARKER):].partition(":")
+        name = name.strip().lower()
+        value = value.strip()
+        if not colon or name not in self.HEADERS:
+            return None
+        if name == 'priority' and value.lower() not in Spool.PRIORITIES:
+            return None
+        if name == 'topic' and SubscriberRegistry.normalize_topic(value) is None:
+            return None
+        return name, value
+
+    def read_headers(self):
+        """
+        Read the optional header lines "@PRIORITY: name" and "@TOPIC: name" the message starts with,
+        skipping the empty lines. A line which is not a valid header is the start of the text.
+        :return: tuple (dict of headers, first line of the message text, bytes)
+        """
+        headers = {}
+        while True:
+            line = self.rfile.readline(MESSAGE_LIMIT)
+            if not line:
+                return headers, line
+            if not line.strip():
+                continue
+            header = self.parse_header(line)
+            if header is None or header[0] in headers:
+                return headers, line
+            headers[header[0]] = header[1]
+
     def handle(self):
         """
         Request handler. Will process the incoming message and broadcast it via Telegram.
         :return: nothing
         """
-        # Oow, that's dirty!
-        # Do you think so?
-        # Well I better not show you
-        # How deploying here is made...
-        global application
+        app = self.server.app
+        documents = app.documents
+        received = time.time()
 
-        # Getting the message
+        # Getting the message, long ones straight to the disk
         try:
             logging.info("Received message %s", self.client_address[0])
-            msg = self.rfile.read().strip().decode('utf-8')
-            logging.info("Message to broadcast: %s", msg)
+            headers, head = self.read_headers()
+            data, document, size, dedup_key = documents.receive(self.rfile, head)
+        except Exception as e:
+            logging.error("Error %s", str(e))
+            return
+
+        if self.server.cut:
+            logging.warning("Message from %s was cut by the shutdown, dropped", self.client_address[0])
+            documents.remove(document)
+            return
+
+        if data is None and document is None:
+            logging.warning("Message from %s is larger than %d bytes, dropped",
+                            self.client_address[0], documents.max_size)
+            self.respond("ERROR: message is too large")
+            METRICS.inc('sender_messages_rejected_total', reason='too_large')
+            return
+
+        # Long messages are sent as documents with the preview
+        try:
+            if document is None:
+                msg = data.strip().decode('utf-8')
+                logging.info("Message to broadcast: %s", msg)
+            else:
+                msg = documents.preview(document, size)
+                logging.info("Message to broadcast as document: %d bytes", size)
         except Exception as e:
             logging.error("Error %s", str(e))
+            documents.remove(document)
+            return
 
-        # Broadcasting the message
-        application.broadcast(msg)
+        # Putting the message to the spool, delivery thread will broadcast it
+        status = app.ingest(msg, dedup_key=dedup_key, source='tcp', received=received,
+                            priority=headers.get('priority'), topic=headers.get('topic'),
+                            document=document)
+        if status != Application.INGEST_ACCEPTED:
+            documents.remove(document)
+        if status == Application.INGEST_BUSY:
+            self.respond("ERROR: queue is full, try again later")
+        elif status == Application.INGEST_BAD_PRIORITY:
+            self.respond("ERROR: unknown priority")
+        elif status == Application.INGEST_BAD_TOPIC:
+            self.respond("ERROR: bad topic")
 
         logging.info("Handling of message complete!")
 
 
+class FramedTCPRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handler for the framed protocol, for producers keeping the connection open.
+    Every line is one JSON frame: {"text": "message", "id": "optional", "ack": true}, it may also
+    have "dedup_key" to suppress repeats (see DeduplicatorThread), "priority" and "topic".
+    If "ack" is true, the handler answers with a line {"id": ..., "status": ...}.
+    """
+    def setup(self):
+        """
+        Set up the connection, applying the idle timeout.
+        :return: nothing
+        """
+        self.timeout = self.server.app.framed_idle_timeout
+        super().setup()
+
+    def respond(self, frame_id, status):
+        """
+        Send the acknowledgement frame.
+        :param frame_id: ID of the frame from the producer
+        :param status: status of the frame
+        :return: nothing
+        """
+        self.wfile.write((json.dumps({'id': frame_id, 'status': status}) + "\n").encode('utf-8'))
+
+    def handle(self):
+        """
+        Request handler. Will process incoming frames until the producer closes the connection.
+        :return: nothing
+        """
+        app = self.server.app
+        max_size = app.max_message_size
+
+        logging.info("Framed connection from %s", self.client_address[0])
+        frames = 0
+        while app.is_accepting:
+            try:
+                line = self.rfile.readline(max_size + 1)
+            except Exception as e:
+                logging.info("Framed connection from %s closed: %s", self.client_address[0], str(e))
+                break
+            if not line:
+                break
+            if not app.is_accepting and not line.endswith(b"\n"):
+                # The frame was cut by the shutdown, the producer gets no ack for it
+                break
+            if len(line) > max_size:
+                logging.warning("Frame from %s is larger than %d bytes, closing connection",
+                                self.client_address[0], max_size)
+                self.respond(None, 'too_large')
+                break
+            if not line.strip():
+                continue
+
+            try:
+                frame = json.loads(line.decode('utf-8'))
+                text = frame.get('text', '')
+                if not isinstance(text, str):
+                    raise ValueError("text is not a string")
+                text = text.strip()
+            except Exception as e:
+                logging.warning("Bad frame from %s: %s", self.client_address[0], str(e))
+                self.respond(None, 'bad_frame')
+                continue
+
+            status = app.ingest(text, frame.get('dedup_key'), source='framed', received=time.time(),
+                                priority=frame.get('priority'), topic=frame.get('topic'))
+            frames += 1
+            if frame.get('ack'):
+                self.respond(frame.get('id'), status)
+
+        logging.info("Framed connection from %s done, %d frames", self.client_address[0], frames)
+
+
+class HTTPIngestRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler for the HTTP ingest API. POST /messages accepts a JSON array of messages:
+    [{"text": "message", "dedup_key": "optional", "priority": "optional", "topic": "optional"},
+    ...], and answers with the status of every
+    message. Keep-alive connections and gzip request bodies are supported.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        """
+        Set up the connection, applying the read timeout.
+        :return: nothing
+        """
+        self.timeout = self.server.app.read_timeout
+        super().setup()
+
+    def respond(self, code, data):
+        """
+        Send the JSON response.
+        :param code: HTTP status code
+        :param data: response data
+        :return: nothing
+        """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        """
+        Read the request body, decompressing it if needed.
+        :return: body, None if it is larger than allowed
+        :raises: ValueError if the body can not be read
+        """
+        max_size = self.server.app.http_max_body
+        length = int(self.headers.get('Content-Length', 0))
+        if length < 0:
+            raise ValueError("negative Content-Length")
+        if length > max_size:
+            return None
+        body = self.rfile.read(length)
+
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, max_size + 1)
+            except zlib.error as e:
+                raise ValueError("bad gzip body: " + str(e))
+            if len(body) > max_size:
+                return None
+        elif encoding != 'identity':
+            raise ValueError("unsupported Content-Encoding: " + encoding)
+        return body
+
+    def do_POST(self):
+        """
+        Process POST request.
+        :return: nothing
+        """
+        app = self.server.app
+        received = time.time()
+        if self.path.split('?')[0] != '/messages':
+            self.respond(404, {'error': 'not found'})
+            return
+
+        try:
+            body = self.read_body()
+        except ValueError as e:
+            self.close_connection = True
+            self.respond(400, {'error': str(e)})
+            return
+        if body is None:
+            # The body was not read, the connection can not be reused
+            self.close_connection = True
+            METRICS.inc('sender_messages_rejected_total', reason='too_large')
+            self.respond(413, {'error': 'request is too large'})
+            return
+
+        try:
+            items = json.loads(body.decode('utf-8'))
+            if not isinstance(items, list):
+                raise ValueError("JSON array expected")
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+            return
+
+        results = []
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get('text', ''), str):
+                results.append({'status': 'bad_item'})
+                continue
+            status = app.ingest(item.get('text', '').strip(), item.get('dedup_key'),
+                                source='http', received=received, priority=item.get('priority'),
+                                topic=item.get('topic'))
+            results.append({'status': status})
+
+        logging.info("HTTP batch from %s: %d messages", self.client_address[0], len(items))
+        if not app.is_accepting:
+            self.close_connection = True
+        self.respond(200, {'accepted': sum(1 for result in results
+                                           if result['status'] == Application.INGEST_ACCEPTED),
+                           'results': results})
+
+    def log_message(self, format, *args):
+        """
+        Log the request via logging instead of stderr.
+        :return: nothing
+        """
+        #pylint:disable=W0622
+        logging.debug("HTTP request from %s: %s", self.client_address[0], format % args)
+
+
+class IngestTCPServer(socketserver.TCPServer):
+    """
+    TCP server which handles connections concurrently in a bounded pool of threads.
+    Connections above the limit are closed right away.
+    """
+    allow_reuse_address = True
+
+    # Handlers of long-lived connections, which are cut between messages on close
+    INTERRUPTIBLE = ('FramedTCPRequestHandler', 'HTTPIngestRequestHandler')
+
+    def __init__(self, app, port, handler):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.max_connections)
+        self.connections = threading.BoundedSemaphore(app.max_connections)
+
+        # Connections being handled
+        self.requests = set()
+        self.requests_lock = threading.Lock()
+
+        # Set when the connections still uploading at the shutdown deadline are cut
+        self.cut = False
+
+        super().__init__((app.host, port), handler)
+
+    def process_request(self, request, client_address):
+        """
+        Hand the connection over to the pool, or drop it if there are too many.
+        :param request: client socket
+        :param client_address: client address
+        :return: nothing
+        """
+        if not self.connections.acquire(blocking=False):
+            logging.warning("Too many connections, rejecting %s", client_address[0])
+            self.shutdown_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """
+        Handle the connection in the pool thread.
+        :param request: client socket
+        :param client_address: client address
+        :return: nothing
+        """
+        port = str(self.server_address[1])
+        METRICS.inc('sender_connections_active', port=port)
+        with self.requests_lock:
+            self.requests.add(request)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.requests_lock:
+                self.requests.discard(request)
+            self.shutdown_request(request)
+            self.connections.release()
+            METRICS.inc('sender_connections_active', -1, port=port)
+
+    def server_close(self):
+        """
+        Close the server, waiting for the connections in progress. Long-lived connections
+        waiting for the next message are cut, so the wait is bounded by the read timeout.
+        Messages still being uploaded at the shutdown deadline are cut as well.
+        :return: nothing
+        """
+        super().server_close()
+        deadline = self.app.shutdown_deadline
+        if self.RequestHandlerClass.__name__ not in self.INTERRUPTIBLE and deadline is not None:
+            while self.requests and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.cut = True
+        if self.cut or self.RequestHandlerClass.__name__ in self.INTERRUPTIBLE:
+            with self.requests_lock:
+                for request in self.requests:
+                    try:
+                        request.shutdown(socket.SHUT_RD)
+                    except OSError:
+                        pass
+        self.executor.shutdown(wait=True)
+
+
 class TCPServerThread(threading.Thread):
     """
     TCP Server thread, it will run separately from the main one.
     """
+    def __init__(self, app, port, handler=MyTCPRequestHandler):
+        super().__init__()
+
+        self.app = app
+        self.port = port
+        self.handler = handler
+    def run(self):
+        """
+        The 'run' function of TCP Server thread, will create a TCPServer and listen
+        until terminated.
+        :return: nothing
+        """
+        logging.info("TCPServer thread started, port %d.", self.port)
+        # Creating TCP server
+        try:
+            tcp_server = IngestTCPServer(self.app, self.port, self.handler)
+        except Exception as e:
+            logging.critical("Failed to sttart the server, error: %s", str(e))
+            self.app.stop()
+            return
+        tcp_server.timeout = 1
+
+        while self.app.is_accepting:
+            tcp_server.handle_request()
+
+        tcp_server.server_close()
+        logging.info("TCPServer thread terminated.")
+
+
+class DatabasePool:
+    """
+    Pool of long-lived PostgreSQL connections.
+    Connections are checked before use if they were idle for a while, broken connections are
+    replaced, and every query runs as a prepared statement on the server.
+    """
+    # Queries, prepared once per connection
+    STATEMENTS = {'load_chat_ids': "SELECT chat_id, bot_id, quarantined, last_error FROM chats",
+                  'save_chat_id': "INSERT INTO chats(chat_id, bot_id) VALUES ($1, $2) "
+                                  "ON CONFLICT (chat_id) DO UPDATE SET bot_id=EXCLUDED.bot_id, "
+                                  "quarantined=NULL, last_error=NULL",
+                  'quarantine_chat_id': "UPDATE chats SET quarantined=$1, last_error=$2 WHERE chat_id=$3",
+                  'assign_bot_id': "UPDATE chats SET bot_id=$1 WHERE bot_id IS NULL",
+                  'load_topics': "SELECT chat_id, topic FROM chat_topics",
+                  'save_topic': "INSERT INTO chat_topics(chat_id, topic) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                  'delete_topic': "DELETE FROM chat_topics WHERE chat_id=$1 AND topic=$2",
+                  'delete_chat_id': "DELETE FROM chats WHERE chat_id=$1",
+                  'chats_version': "SELECT GREATEST((SELECT MAX(version) FROM chats), "
+                                   "(SELECT MAX(version) FROM chats_removed), "
+                                   "(SELECT MAX(version) FROM chat_topics), "
+                                   "(SELECT MAX(version) FROM chat_topics_removed))",
+                  'chats_changes': "SELECT version, chat_id, bot_id, quarantined, last_error, NULL, FALSE "
+                                   "FROM chats WHERE version > $1 "
+                                   "UNION ALL SELECT version, chat_id, NULL, NULL, NULL, NULL, TRUE "
+                                   "FROM chats_removed WHERE version > $1 "
+                                   "UNION ALL SELECT version, chat_id, NULL, NULL, NULL, topic, FALSE "
+                                   "FROM chat_topics WHERE version > $1 "
+                                   "UNION ALL SELECT version, chat_id, NULL, NULL, NULL, topic, TRUE "
+                                   "FROM chat_topics_removed WHERE version > $1 ORDER BY 1"}
+
+    # Queries listing the existing parts of the schema, by kind; columns and triggers
+    # are listed as "table.name"
+    SCHEMA_QUERIES = {'table': "SELECT table_name FROM information_schema.tables "
+                               "WHERE table_schema = current_schema()",
+                      'column': "SELECT table_name || '.' || column_name FROM information_schema.columns "
+                                "WHERE table_schema = current_schema()",
+                      'sequence': "SELECT sequence_name FROM information_schema.sequences "
+                                  "WHERE sequence_schema = current_schema()",
+                      'index': "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()",
+                      'function': "SELECT routine_name FROM information_schema.routines "
+                                  "WHERE routine_schema = current_schema()",
+                      'trigger': "SELECT c.relname || '.' || t.tgname FROM pg_trigger t "
+                                 "JOIN pg_class c ON c.oid = t.tgrelid JOIN pg_namespace n ON n.oid = c.relnamespace "
+                                 "WHERE n.nspname = current_schema() AND NOT t.tgisinternal"}
+
+    # Connections idle longer than this (seconds) are checked before use
+    HEALTH_CHECK_INTERVAL = 30
+
+    def __init__(self, db_settings, size=4):
+        self.db_settings = db_settings
+        self.size = size
+
+        # Pool is created on first use, so the bot can start while the database is down
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+        # psycopg2 pool does not block when exhausted, this semaphore does
+        self.available = threading.BoundedSemaphore(size)
+
+        # Per connection: names of prepared statements and time of last use. Keyed by the
+        # connection itself, entries of closed connections go away with them
+        self.prepared = weakref.WeakKeyDictionary()
+        self.last_used = weakref.WeakKeyDictionary()
+
+        # Number of connections taken from the pool
+        self.in_use = 0
+
+    def connect(self):
+        """
+        Open a separate connection, not taken from the pool.
+        :return: connection
+        """
+        return psycopg2.connect(dbname=self.db_settings['db_name'],
+                                host=self.db_settings['db_host'],
+                                user=self.db_settings['db_user'],
+                                port=self.db_settings['db_port'],
+                                password=self.db_settings['db_pass'])
+
+    def getconn(self):
+        """
+        Take a healthy connection from the pool, blocking until one is available.
+        :return: connection
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                # The pool closes the connections given back above minconn, all of them are kept
+                self.pool = psycopg2.pool.ThreadedConnectionPool(self.size, self.size,
+                                                                 dbname=self.db_settings['db_name'],
+                                                                 host=self.db_settings['db_host'],
+                                                                 user=self.db_settings['db_user'],
+                                                                 port=self.db_settings['db_port'],
+                                                                 password=self.db_settings['db_pass'])
+
+        self.available.acquire()
+        with self.pool_lock:
+            self.in_use += 1
+        try:
+            conn = self.pool.getconn()
+            # Fresh connections have no record of use and need no check
+            idle = time.monotonic() - self.last_used.get(conn, time.monotonic())
+            if conn.closed:
+                self.discard(conn)
+                conn = self.pool.getconn()
+            elif idle > self.HEALTH_CHECK_INTERVAL:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    conn.rollback()
+                except psycopg2.Error as e:
+                    logging.warning("Database connection is broken (%s), reconnecting", str(e))
+                    self.discard(conn)
+                    conn = self.pool.getconn()
+        except Exception:
+            self.release()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        """
+        Return the connection to the pool.
+        :param conn: connection
+        :return: nothing
+        """
+        self.last_used[conn] = time.monotonic()
+        self.pool.putconn(conn)
+        self.release()
+
+    def release(self):
+        """
+        Give back the slot taken by getconn.
+        :return: nothing
+        """
+        with self.pool_lock:
+            self.in_use -= 1
+        self.available.release()
+
+    def discard(self, conn):
+        """
+        Close the connection and remove it from the pool. Semaphore is not released.
+        :param conn: connection
+        :return: nothing
+        """
+        self.prepared.pop(conn, None)
+        self.last_used.pop(conn, None)
+        try:
+            self.pool.putconn(conn, close=True)
+        except Exception as e:
+            logging.debug("Exception (discard connection): %s", str(e))
+
+    def prepare(self, conn, name):
+        """
+        Prepare the statement on the connection if it is not prepared yet.
+        :param conn: connection
+        :param name: statement name, key of STATEMENTS
+        :return: nothing
+        """
+        prepared = self.prepared.setdefault(conn, set())
+        if name in prepared:
+            return
+        with conn.cursor() as cur:
+            cur.execute("PREPARE " + name + " AS " + self.STATEMENTS[name])
+        conn.commit()
+        prepared.add(name)
+
+    def run(self, func):
+        """
+        Run the function in a transaction on a pooled connection, reconnecting once if the
+        connection is lost.
+        :param func: function taking (connection, cursor), its result is returned
+        :return: result of the function
+        :raises: psycopg2.Error if the query failed
+        """
+        for attempt in range(2):
+            conn = self.getconn()
+            try:
+                with conn.cursor() as cur:
+                    result = func(conn, cur)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self.discard(conn)
+                self.release()
+                if attempt:
+                    raise
+                logging.warning("Database connection lost (%s), reconnecting", str(e))
+                continue
+            except Exception:
+                # Connection state is unknown after the failure, not reusing it
+                self.discard(conn)
+                self.release()
+                raise
+            self.putconn(conn)
+            return result
+
+    def execute(self, name, params=(), fetch=False):
+        """
+        Execute the prepared statement.
+        :param name: statement name, key of STATEMENTS
+        :param params: statement parameters
+        :param fetch: if True, return the rows
+        :return: list of rows if fetch is True, nothing otherwise
+        :raises: psycopg2.Error if the query failed
+        """
+        placeholders = ", ".join(["%s"] * len(params))
+        query = "EXECUTE " + name + (" (" + placeholders + ")" if placeholders else "")
+
+        def execute_prepared(conn, cur):
+            self.prepare(conn, name)
+            cur.execute(query, params)
+            return cur.fetchall() if fetch else None
+
+        return self.run(execute_prepared)
+
+    def migrate(self, schema):
+        """
+        Create the missing parts of the schema. Existing parts are left alone, so nothing is
+        altered in the up-to-date database: changing a table needs its owner, while the bot
+        may only be granted the privileges.
+        :param schema: list of tuples (kind, name, statements creating the part), kind is a key
+                       of SCHEMA_QUERIES
+        :return: list of names of the parts created
+        :raises: psycopg2.Error if the query failed
+        """
+        def migrate_schema(conn, cur):
+            existing = {}
+            for kind in set(part[0] for part in schema):
+                cur.execute(self.SCHEMA_QUERIES[kind])
+                existing[kind] = set(row[0] for row in cur.fetchall())
+
+            created = []
+            for kind, name, statements in schema:
+                if name in existing[kind]:
+                    continue
+                for statement in statements:
+                    cur.execute(statement)
+                created.append(name)
+            return created
+
+        return self.run(migrate_schema)
+
+    def execute_values(self, query, rows, page_size=1000):
+        """
+        Execute the bulk query, sending rows in pages. See psycopg2.extras.execute_values.
+        :param query: query with a single %s for the VALUES list
+        :param rows: list of row tuples
+        :param page_size: rows per statement
+        :return: nothing
+        :raises: psycopg2.Error if the query failed
+        """
+        self.run(lambda conn, cur: psycopg2.extras.execute_values(cur, query, rows,
+                                                                  page_size=page_size))
+
+    def close(self):
+        """
+        Close all connections.
+        :return: nothing
+        """
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+            self.prepared.clear()
+            self.last_used.clear()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler for the metrics HTTP server, serves /metrics in Prometheus text format.
+    """
+    def do_GET(self):
+        """
+        Process GET request.
+        :return: nothing
+        """
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = METRICS.export().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Log the request via logging instead of stderr.
+        :return: nothing
+        """
+        #pylint:disable=W0622
+        logging.debug("Metrics request from %s: %s", self.client_address[0], format % args)
+
+
+class MetricsServerThread(threading.Thread):
+    """
+    Metrics server thread, it will run separately from the main one.
+    """
     def __init__(self, app):
         super().__init__()
 
         self.app = app
     def run(self):
         """
-        The 'run' function of TCP Server thread, will create a TCPServer and listen
-        until terminated.
+        The 'run' function of metrics server thread, will create a HTTPServer and listen
+        until terminated.
+        :return: nothing
+        """
+        logging.info("Metrics server thread started, port %d.", self.app.metrics_port)
+        try:
+            http_server = http.server.HTTPServer((self.app.host, self.app.metrics_port),
+                                                 MetricsRequestHandler)
+        except Exception as e:
+            logging.error("Failed to start the metrics server, error: %s", str(e))
+            return
+        http_server.timeout = 1
+
+        while self.app.is_running:
+            http_server.handle_request()
+
+        http_server.server_close()
+        logging.info("Metrics server thread terminated.")
+
+
+class SubscriberStore:
+    """
+    Base class of the subscriber storage. Methods raise exceptions on errors.
+    """
+    def migrate(self):
+        """
+        Bring the schema of the storage up to date.
+        :return: nothing
+        """
+
+    def load(self):
+        """
+        Load all chat IDs.
+        :return: list of tuples (chat ID, ID of the bot serving the chat or None,
+                 quarantine time or None, last error or None)
+        """
+        raise NotImplementedError
+
+    def add(self, chat_id, bot_id=None):
+        """
+        Add one chat ID, updating its bot and lifting its quarantine if it is there already.
+        :param chat_id: chat ID
+        :param bot_id: ID of the bot serving the chat
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def set_quarantine(self, chat_id, quarantined=None, error=None):
+        """
+        Quarantine the chat, or lift its quarantine.
+        :param chat_id: chat ID
+        :param quarantined: quarantine time (unix time), None to lift the quarantine
+        :param error: error which made the chat quarantined
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def bulk_add(self, chat_ids):
+        """
+        Add many chat IDs at once, skipping existing ones.
+        :param chat_ids: list of chat IDs
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def assign_bot(self, bot_id):
+        """
+        Set the bot of the chats which have none.
+        :param bot_id: bot ID
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def remove(self, chat_id):
+        """
+        Remove the chat ID, together with its topics.
+        :param chat_id: chat ID
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def load_topics(self):
+        """
+        Load all topic subscriptions.
+        :return: list of tuples (chat ID, topic)
+        """
+        raise NotImplementedError
+
+    def add_topic(self, chat_id, topic):
+        """
+        Subscribe the chat to the topic, doing nothing if it is subscribed already.
+        :param chat_id: chat ID
+        :param topic: topic
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def remove_topic(self, chat_id, topic):
+        """
+        Unsubscribe the chat from the topic.
+        :param chat_id: chat ID
+        :param topic: topic
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the resources of the storage.
+        :return: nothing
+        """
+
+
+class PostgresStore(SubscriberStore):
+    """
+    Subscriber storage in PostgreSQL, using the pool of connections.
+    Every change of chats and their topics gets a new version and is announced on the NOTIFY channel, so
+    several instances of the bot can keep their subscribers in sync, see ChatSyncThread.
+    """
+    # NOTIFY channel of the changes of chats
+    CHANNEL = 'chats_changed'
+
+    # Parts of the schema added after the chats table, see DatabasePool.migrate. The change feed
+    # gives versions to the rows of chats and chat_topics, records the removed ones and sends
+    # the notifications
+    SCHEMA = (
+        ('column', 'chats.bot_id', ("ALTER TABLE chats ADD COLUMN bot_id varchar",)),
+        ('column', 'chats.quarantined', ("ALTER TABLE chats ADD COLUMN quarantined double precision",)),
+        ('column', 'chats.last_error', ("ALTER TABLE chats ADD COLUMN last_error varchar",)),
+        ('table', 'chat_topics', ("CREATE TABLE chat_topics ("
+                                  " chat_id varchar REFERENCES chats(chat_id) ON DELETE CASCADE,"
+                                  " topic varchar,"
+                                  " PRIMARY KEY (chat_id, topic))",)),
+        ('sequence', 'chats_version_seq', ("CREATE SEQUENCE chats_version_seq",)),
+        ('column', 'chats.version', ("ALTER TABLE chats ADD COLUMN version bigint",
+                                     "UPDATE chats SET version=nextval('chats_version_seq')")),
+        ('index', 'chats_version', ("CREATE INDEX chats_version ON chats(version)",)),
+        ('table', 'chats_removed', ("CREATE TABLE chats_removed ("
+                                    " chat_id varchar PRIMARY KEY,"
+                                    " version bigint NOT NULL)",)),
+        ('index', 'chats_removed_version', ("CREATE INDEX chats_removed_version ON chats_removed(version)",)),
+        ('function', 'chats_changed', (
+            "CREATE FUNCTION chats_changed() RETURNS trigger AS $$\n"
+            "BEGIN\n"
+            "    IF TG_OP = 'DELETE' THEN\n"
+            "        INSERT INTO chats_removed(chat_id, version)\n"
+            "            VALUES (OLD.chat_id, nextval('chats_version_seq'))\n"
+            "            ON CONFLICT (chat_id) DO UPDATE SET version=EXCLUDED.version;\n"
+            "        PERFORM pg_notify('chats_changed',\n"
+            "                          json_build_object('op', 'remove', 'chat_id', OLD.chat_id)::text);\n"
+            "        RETURN OLD;\n"
+            "    END IF;\n"
+            "    NEW.version := nextval('chats_version_seq');\n"
+            "    DELETE FROM chats_removed WHERE chat_id=NEW.chat_id;\n"
+            "    PERFORM pg_notify('chats_changed',\n"
+            "                      json_build_object('op', 'add', 'chat_id', NEW.chat_id,\n"
+            "                                        'bot_id', NEW.bot_id,\n"
+            "                                        'quarantined', NEW.quarantined,\n"
+            "                                        'last_error', NEW.last_error)::text);\n"
+            "    RETURN NEW;\n"
+            "END;\n"
+            "$$ LANGUAGE plpgsql",)),
+        ('trigger', 'chats.chats_changed', ("CREATE TRIGGER chats_changed BEFORE INSERT OR UPDATE ON chats"
+                                            " FOR EACH ROW EXECUTE PROCEDURE chats_changed()",)),
+        ('trigger', 'chats.chats_removed', ("CREATE TRIGGER chats_removed AFTER DELETE ON chats"
+                                            " FOR EACH ROW EXECUTE PROCEDURE chats_changed()",)),
+        ('column', 'chat_topics.version', ("ALTER TABLE chat_topics ADD COLUMN version bigint",
+                                           "UPDATE chat_topics SET version=nextval('chats_version_seq')")),
+        ('index', 'chat_topics_version', ("CREATE INDEX chat_topics_version ON chat_topics(version)",)),
+        ('table', 'chat_topics_removed', ("CREATE TABLE chat_topics_removed ("
+                                          " chat_id varchar,"
+                                          " topic varchar,"
+                                          " version bigint NOT NULL,"
+                                          " PRIMARY KEY (chat_id, topic))",)),
+        ('index', 'chat_topics_removed_version', ("CREATE INDEX chat_topics_removed_version"
+                                                  " ON chat_topics_removed(version)",)),
+        ('function', 'chat_topics_changed', (
+            "CREATE FUNCTION chat_topics_changed() RETURNS trigger AS $$\n"
+            "BEGIN\n"
+            "    IF TG_OP = 'DELETE' THEN\n"
+            "        INSERT INTO chat_topics_removed(chat_id, topic, version)\n"
+            "            VALUES (OLD.chat_id, OLD.topic, nextval('chats_version_seq'))\n"
+            "            ON CONFLICT (chat_id, topic) DO UPDATE SET version=EXCLUDED.version;\n"
+            "        PERFORM pg_notify('chats_changed',\n"
+            "                          json_build_object('op', 'unsubscribe', 'chat_id', OLD.chat_id,\n"
+            "                                            'topic', OLD.topic)::text);\n"
+            "        RETURN OLD;\n"
+            "    END IF;\n"
+            "    NEW.version := nextval('chats_version_seq');\n"
+            "    DELETE FROM chat_topics_removed WHERE chat_id=NEW.chat_id AND topic=NEW.topic;\n"
+            "    PERFORM pg_notify('chats_changed',\n"
+            "                      json_build_object('op', 'subscribe', 'chat_id', NEW.chat_id,\n"
+            "                                        'topic', NEW.topic)::text);\n"
+            "    RETURN NEW;\n"
+            "END;\n"
+            "$$ LANGUAGE plpgsql",)),
+        ('trigger', 'chat_topics.chat_topics_changed', ("CREATE TRIGGER chat_topics_changed"
+                                                        " BEFORE INSERT OR UPDATE ON chat_topics"
+                                                        " FOR EACH ROW EXECUTE PROCEDURE chat_topics_changed()",)),
+        ('trigger', 'chat_topics.chat_topics_removed', ("CREATE TRIGGER chat_topics_removed"
+                                                        " AFTER DELETE ON chat_topics"
+                                                        " FOR EACH ROW EXECUTE PROCEDURE chat_topics_changed()",)),
+    )
+
+    def __init__(self, db_settings, pool_size=4):
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is not installed, PostgreSQL storage is not available")
+        self.db_pool = DatabasePool(db_settings, size=pool_size)
+
+    def migrate(self):
+        created = self.db_pool.migrate(self.SCHEMA)
+        if created:
+            logging.info("Database schema updated: %s", ", ".join(created))
+
+    def load(self):
+        return [tuple(row) for row in self.db_pool.execute('load_chat_ids', fetch=True)]
+
+    def add(self, chat_id, bot_id=None):
+        self.db_pool.execute('save_chat_id', (str(chat_id), bot_id))
+
+    def set_quarantine(self, chat_id, quarantined=None, error=None):
+        self.db_pool.execute('quarantine_chat_id', (quarantined, error, str(chat_id)))
+
+    def bulk_add(self, chat_ids):
+        self.db_pool.execute_values("INSERT INTO chats(chat_id) VALUES %s ON CONFLICT DO NOTHING",
+                                    [(str(chat_id),) for chat_id in chat_ids])
+
+    def assign_bot(self, bot_id):
+        self.db_pool.execute('assign_bot_id', (bot_id,))
+
+    def remove(self, chat_id):
+        # Topics of the chat are deleted by the foreign key
+        self.db_pool.execute('delete_chat_id', (str(chat_id),))
+
+    def load_topics(self):
+        return [(row[0], row[1]) for row in self.db_pool.execute('load_topics', fetch=True)]
+
+    def add_topic(self, chat_id, topic):
+        self.db_pool.execute('save_topic', (str(chat_id), topic))
+
+    def remove_topic(self, chat_id, topic):
+        self.db_pool.execute('delete_topic', (str(chat_id), topic))
+
+    def version(self):
+        """
+        Get the version of the last change of chats or their topics.
+        :return: version, 0 if there were no changes
+        """
+        return self.db_pool.execute('chats_version', fetch=True)[0][0] or 0
+
+    def changes(self, since):
+        """
+        Get the changes of chats and their topics made after the version.
+        :param since: version
+        :return: list of tuples (version, chat ID, bot ID, quarantine time, last error, topic, removed),
+                 ordered by version; topic is None for the changes of chats
+        """
+        return [tuple(row) for row in self.db_pool.execute('chats_changes', (since,), fetch=True)]
+
+    def listen(self):
+        """
+        Open the connection listening to the changes of chats and their topics.
+        :return: connection, notifications are JSON objects {"op": "add", "remove", "subscribe"
+                 or "unsubscribe", "chat_id": ..., ...}
+        """
+        conn = self.db_pool.connect()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("LISTEN " + self.CHANNEL)
+        return conn
+
+    def close(self):
+        self.db_pool.close()
+
+
+class SQLiteStore(SubscriberStore):
+    """
+    Subscriber storage in the embedded SQLite database (WAL mode), for small installations
+    where running PostgreSQL is too much.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chats ("
+                          " chat_id TEXT PRIMARY KEY,"
+                          " bot_id TEXT,"
+                          " quarantined REAL,"
+                          " last_error TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chat_topics ("
+                          " chat_id TEXT NOT NULL,"
+                          " topic TEXT NOT NULL,"
+                          " PRIMARY KEY (chat_id, topic))")
+        self.conn.commit()
+
+    def migrate(self):
+        with self.lock:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chats)")]
+            for column, column_type in (('bot_id', 'TEXT'), ('quarantined', 'REAL'), ('last_error', 'TEXT')):
+                if column not in columns:
+                    self.conn.execute("ALTER TABLE chats ADD COLUMN " + column + " " + column_type)
+            self.conn.commit()
+
+    def load(self):
+        with self.lock:
+            return [tuple(row) for row in self.conn.execute("SELECT chat_id, bot_id, quarantined, last_error "
+                                                            "FROM chats")]
+
+    def add(self, chat_id, bot_id=None):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO chats(chat_id, bot_id) VALUES (?, ?)",
+                              (str(chat_id), bot_id))
+            self.conn.commit()
+
+    def set_quarantine(self, chat_id, quarantined=None, error=None):
+        with self.lock:
+            self.conn.execute("UPDATE chats SET quarantined=?, last_error=? WHERE chat_id=?",
+                              (quarantined, error, str(chat_id)))
+            self.conn.commit()
+
+    def bulk_add(self, chat_ids):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO chats(chat_id) VALUES (?)",
+                                  ((str(chat_id),) for chat_id in chat_ids))
+            self.conn.commit()
+
+    def assign_bot(self, bot_id):
+        with self.lock:
+            self.conn.execute("UPDATE chats SET bot_id=? WHERE bot_id IS NULL", (bot_id,))
+            self.conn.commit()
+
+    def remove(self, chat_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM chat_topics WHERE chat_id=?", (str(chat_id),))
+            self.conn.execute("DELETE FROM chats WHERE chat_id=?", (str(chat_id),))
+            self.conn.commit()
+
+    def load_topics(self):
+        with self.lock:
+            return [(row[0], row[1]) for row in self.conn.execute("SELECT chat_id, topic FROM chat_topics")]
+
+    def add_topic(self, chat_id, topic):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO chat_topics(chat_id, topic) VALUES (?, ?)",
+                              (str(chat_id), topic))
+            self.conn.commit()
+
+    def remove_topic(self, chat_id, topic):
+        with self.lock:
+            self.conn.execute("DELETE FROM chat_topics WHERE chat_id=? AND topic=?",
+                              (str(chat_id), topic))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class DocumentSpool:
+    """
+    Directory keeping the payloads too long for a text message until they are delivered
+    as documents. Payloads are streamed to the files in chunks, so memory use does not depend
+    on their size. Files are named by the hash of the content.
+    """
+    # Bytes read from the stream at once
+    CHUNK = 65536
+
+    # Payloads up to this size may fit into one text message and are kept in memory,
+    # every character takes at most 4 bytes in UTF-8
+    MEMORY_LIMIT = MESSAGE_LIMIT * 4
+
+    # Name the document is sent with
+    DOCUMENT_NAME = 'message.txt'
+
+    def __init__(self, path, max_size):
+        self.path = path
+
+        # Payloads larger than this (bytes) are refused
+        self.max_size = max_size
+
+    def tempfile(self):
+        """
+        Create the temporary file in the directory, creating the directory if needed.
+        :return: open binary file
+        """
+        os.makedirs(self.path, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.path, prefix='incoming_', delete=False)
+
+    def finish(self, temp, digest):
+        """
+        Move the received temporary file to its final name.
+        :param temp: temporary file, closed
+        :param digest: hash of the content
+        :return: path to the document
+        """
+        path = os.path.join(self.path, digest + '_' + os.path.basename(temp.name))
+        os.rename(temp.name, path)
+        return path
+
+    def receive(self, stream, head=b''):
+        """
+        Read the stream until the end. Short payloads are kept in memory, longer ones are
+        written to a new document.
+        :param stream: binary stream to read
+        :param head: bytes already read from the stream
+        :return: tuple (data, path, size, hash of the content): data is the payload kept in memory,
+                 path is the document the payload was written to instead; both are None if
+                 the payload is larger than max_size
+        """
+        data = head
+        if len(data) <= self.MEMORY_LIMIT:
+            data += stream.read(self.MEMORY_LIMIT + 1 - len(data))
+        if len(data) <= self.MEMORY_LIMIT:
+            return data, None, len(data), None
+
+        digest = hashlib.sha256()
+        size = 0
+        temp = self.tempfile()
+        try:
+            with temp:
+                chunk = data
+                while chunk:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        break
+                    digest.update(chunk)
+                    temp.write(chunk)
+                    chunk = stream.read(self.CHUNK)
+        except Exception:
+            self.remove(temp.name)
+            raise
+        if size > self.max_size:
+            self.remove(temp.name)
+            return None, None, size, None
+        return None, self.finish(temp, digest.hexdigest()), size, digest.hexdigest()
+
+    def save(self, text):
+        """
+        Write the text to a new document.
+        :param text: text
+        :return: path to the document
+        """
+        data = text.encode('utf-8')
+        temp = self.tempfile()
+        with temp:
+            temp.write(data)
+        return self.finish(temp, hashlib.sha256(data).hexdigest())
+
+    @staticmethod
+    def preview(path, size=None, limit=CAPTION_LIMIT):
+        """
+        Make the preview of the document: its first lines, and the size of the whole.
+        :param path: path to the document
+        :param size: size of the document in bytes, taken from the file if None
+        :param limit: maximum length of the preview
+        :return: preview text
+        """
+        size = os.path.getsize(path) if size is None else size
+        with open(path, 'rb') as document:
+            head = document.read(limit * 4).decode('utf-8', 'ignore')
+        return make_preview(head, size, limit)
+
+    @staticmethod
+    def remove(path):
+        """
+        Remove the document, if it is still there.
+        :param path: path to the document, None to do nothing
+        :return: nothing
+        """
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error("Exception (remove document): %s", str(e))
+
+
+class Spool:
+    """
+    Durable outbound spool, SQLite database in WAL mode.
+    Incoming messages are appended here and acknowledged right away, the delivery thread drains
+    the spool later. Progress of every chat is checkpointed, so after the restart the delivery
+    continues where it stopped.
+    Every message belongs to a priority lane, messages of a lane may expire after its TTL.
+    A message with a topic goes only to the subscribers of the topic. A message with a document
+    (see DocumentSpool) owns its file, the file is removed with the message.
+    """
+    # Priority lanes, the lower the more urgent
+    PRIORITY_CRITICAL = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BULK = 2
+    PRIORITIES = {'critical': PRIORITY_CRITICAL,
+                  'normal': PRIORITY_NORMAL,
+                  'bulk': PRIORITY_BULK}
+
+    def __init__(self, path, ttls=None):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # Lane -> seconds its messages live in the spool, lanes not here never expire
+        self.ttls = ttls or {}
+
+        # Set when a new message is appended, wakes up the delivery thread
+        self.new_message = threading.Event()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS messages ("
+                          " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                          " text TEXT NOT NULL,"
+                          " created REAL NOT NULL,"
+                          " expanded INTEGER NOT NULL DEFAULT 0,"
+                          " priority INTEGER NOT NULL DEFAULT 1,"
+                          " expires REAL,"
+                          " topic TEXT,"
+                          " document TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS deliveries ("
+                          " message_id INTEGER NOT NULL,"
+                          " chat_id TEXT NOT NULL,"
+                          " state TEXT NOT NULL DEFAULT 'pending',"
+                          " error TEXT,"
+                          " PRIMARY KEY (message_id, chat_id))")
+
+        # Spools of the older versions have no lanes
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(messages)")]
+        if 'priority' not in columns:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN priority INTEGER NOT NULL DEFAULT 1")
+            self.conn.execute("ALTER TABLE messages ADD COLUMN expires REAL")
+        if 'topic' not in columns:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN topic TEXT")
+        if 'document' not in columns:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN document TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_priority ON messages(priority, id)")
+        self.conn.commit()
+
+    def append(self, text, created=None, priority=PRIORITY_NORMAL, topic=None, ttl=None, document=None):
+        """
+        Append the message to the spool. Returns after the message is on disk.
+        :param text: message text, the caption if the message is a document
+        :param created: time the message was received (unix time), now if None
+        :param priority: priority lane of the message
+        :param topic: topic of the message, None to send it to all subscribers
+        :param ttl: seconds the message lives in the spool, None for the TTL of the lane
+        :param document: path to the document to send, None for a text message
+        :return: message ID
+        """
+        created = created or time.time()
+        if ttl is None:
+            ttl = self.ttls.get(priority)
+        with self.lock:
+            cur = self.conn.execute("INSERT INTO messages(text, created, priority, expires, topic, document) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    (text, created, priority, created + ttl if ttl else None, topic,
+                                     document))
+            self.conn.commit()
+        self.new_message.set()
+        return cur.lastrowid
+
+    def size(self):
+        """
+        Number of messages waiting in the spool.
+        :return: number of messages
+        """
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def lanes(self):
+        """
+        Get the priority lanes having messages.
+        :return: list of lanes
+        """
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT priority FROM messages")]
+
+    def next_message(self, priority=PRIORITY_NORMAL):
+        """
+        Get the oldest message in the lane.
+        :param priority: priority lane
+        :return: tuple (id, text, expanded, created, topic, document), None if the lane is empty
+        """
+        with self.lock:
+            return self.conn.execute("SELECT id, text, expanded, created, topic, document FROM messages "
+                                     "WHERE priority=? ORDER BY id LIMIT 1", (priority,)).fetchone()
+
+    def expire(self, now=None):
+        """
+        Remove the messages which outlived their TTL, delivered or not.
+        :param now: current time (unix time), now if None
+        :return: list of IDs of the removed messages
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT id, document FROM messages WHERE expires<=?",
+                                     (now or time.time(),)).fetchall()
+            ids = [row[0] for row in rows]
+            if ids:
+                self.conn.executemany("DELETE FROM deliveries WHERE message_id=?", ((i,) for i in ids))
+                self.conn.executemany("DELETE FROM messages WHERE id=?", ((i,) for i in ids))
+                self.conn.commit()
+        for _, document in rows:
+            DocumentSpool.remove(document)
+        return ids
+
+    def expand(self, message_id, chat_ids):
+        """
+        Record the recipients of the message, each one gets its own checkpoint.
+        :param message_id: message ID
+        :param chat_ids: recipients of the message
+        :return: nothing
+        """
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO deliveries(message_id, chat_id) VALUES (?, ?)",
+                                  ((message_id, str(chat_id)) for chat_id in chat_ids))
+            self.conn.execute("UPDATE messages SET expanded=1 WHERE id=?", (message_id,))
+            self.conn.commit()
+
+    def pending(self, message_id, limit):
+        """
+        Get the recipients the message was not delivered to yet.
+        :param message_id: message ID
+        :param limit: maximum number of recipients to return
+        :return: list of chat IDs
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT chat_id FROM deliveries "
+                                     "WHERE message_id=? AND state='pending' LIMIT ?",
+                                     (message_id, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def checkpoint(self, message_id, summary):
+        """
+        Save the delivery results for the message.
+        :param message_id: message ID
+        :param summary: delivery summary, see Broadcaster.broadcast
+        :return: nothing
+        """
+        delivered = summary['delivered'] + summary['retried']
+        with self.lock:
+            self.conn.executemany("UPDATE deliveries SET state='delivered' "
+                                  "WHERE message_id=? AND chat_id=?",
+                                  ((message_id, str(chat_id)) for chat_id in delivered))
+            self.conn.executemany("UPDATE deliveries SET state='failed', error=? "
+                                  "WHERE message_id=? AND chat_id=?",
+                                  ((error, message_id, str(chat_id))
+                                   for chat_id, error in summary['failed']))
+            self.conn.commit()
+
+    def complete(self, message_id):
+        """
+        Remove the fully processed message from the spool.
+        :param message_id: message ID
+        :return: nothing
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT document FROM messages WHERE id=?", (message_id,)).fetchone()
+            self.conn.execute("DELETE FROM deliveries WHERE message_id=?", (message_id,))
+            self.conn.execute("DELETE FROM messages WHERE id=?", (message_id,))
+            self.conn.commit()
+        if row:
+            DocumentSpool.remove(row[0])
+
+    def close(self):
+        """
+        Close the spool database.
+        :return: nothing
+        """
+        with self.lock:
+            self.conn.close()
+
+
+class JobQueue:
+    """
+    Base class of the delivery job queue shared by several instances of the bot.
+    Ingest nodes append messages, every message is written as one delivery job per recipient,
+    and any number of workers claim batches of jobs, send them and mark them done. Jobs claimed
+    by one worker are skipped by the others, and the jobs of a worker which died are released,
+    so a message is delivered at least once. Documents are kept in the document spool, which
+    should be shared by the instances as well. Methods raise exceptions on errors.
+    """
+    def __init__(self, ttls=None):
+        # Lane -> seconds its messages live in the queue, lanes not here never expire
+        self.ttls = ttls or {}
+
+        # Set when a message is appended by this instance, wakes up its delivery thread
+        self.new_message = threading.Event()
+
+    def append(self, text, created=None, priority=Spool.PRIORITY_NORMAL, topic=None, ttl=None, document=None):
+        """
+        Append the message and its delivery jobs to the queue.
+        :param text: message text, the caption if the message is a document
+        :param created: time the message was received (unix time), now if None
+        :param priority: priority lane of the message
+        :param topic: topic of the message, None to send it to all subscribers
+        :param ttl: seconds the message lives in the queue, None for the TTL of the lane
+        :param document: path to the document to send, None for a text message
+        :return: message ID
+        """
+        raise NotImplementedError
+
+    def size(self):
+        """
+        Number of messages waiting in the queue.
+        :return: number of messages
+        """
+        raise NotImplementedError
+
+    def lanes(self):
+        """
+        Get the priority lanes having jobs to send.
+        :return: list of lanes
+        """
+        raise NotImplementedError
+
+    def process(self, priority, limit, send):
+        """
+        Claim a batch of jobs of the lane, send them and save the results. Messages having
+        all of their jobs done are removed from the queue.
+        :param priority: priority lane
+        :param limit: maximum number of jobs to claim
+        :param send: function (chat_ids, text, document) returning the delivery summary,
+                     see Broadcaster.broadcast
+        :return: tuple (number of jobs claimed, list of tuples (message ID, created) of the
+                 messages completed)
+        """
+        raise NotImplementedError
+
+    def expire(self, now=None):
+        """
+        Remove the messages which outlived their TTL, and the ones having no jobs to send.
+        :param now: current time (unix time), now if None
+        :return: list of IDs of the expired messages
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Close the queue.
+        :return: nothing
+        """
+
+    @staticmethod
+    def group(rows):
+        """
+        Group the claimed jobs by message.
+        :param rows: list of tuples (message ID, chat ID, text, created, document)
+        :return: OrderedDict message ID -> (text, created, document, list of chat IDs)
+        """
+        messages = collections.OrderedDict()
+        for message_id, chat_id, text, created, document in rows:
+            messages.setdefault(message_id, (text, created, document, []))[3].append(chat_id)
+        return messages
+
+
+class PostgresJobQueue(JobQueue):
+    """
+    Job queue in PostgreSQL, next to the chats table. Recipients are expanded by the database
+    from the chats and chat_topics tables, and a worker keeps its batch locked
+    (SELECT ... FOR UPDATE SKIP LOCKED) while sending it, so the jobs of a worker which died
+    are released with its transaction.
+    """
+    # Tables of the queue, see DatabasePool.migrate
+    SCHEMA = (
+        ('table', 'job_messages', ("CREATE TABLE job_messages ("
+                                   " id bigserial PRIMARY KEY,"
+                                   " text text NOT NULL,"
+                                   " created double precision NOT NULL,"
+                                   " priority integer NOT NULL DEFAULT 1,"
+                                   " expires double precision,"
+                                   " topic varchar)",)),
+        ('column', 'job_messages.document', ("ALTER TABLE job_messages ADD COLUMN document varchar",)),
+        ('index', 'job_messages_expires', ("CREATE INDEX job_messages_expires ON job_messages(expires)"
+                                           " WHERE expires IS NOT NULL",)),
+        ('table', 'job_deliveries', ("CREATE TABLE job_deliveries ("
+                                     " message_id bigint NOT NULL REFERENCES job_messages(id) ON DELETE CASCADE,"
+                                     " chat_id varchar NOT NULL,"
+                                     " priority integer NOT NULL DEFAULT 1,"
+                                     " state varchar NOT NULL DEFAULT 'pending',"
+                                     " error varchar,"
+                                     " PRIMARY KEY (message_id, chat_id))",)),
+        ('index', 'job_deliveries_pending', ("CREATE INDEX job_deliveries_pending"
+                                             " ON job_deliveries(priority, message_id) WHERE state = 'pending'",)),
+    )
+
+    def __init__(self, db_settings, pool_size=4, ttls=None):
+        super().__init__(ttls)
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is not installed, PostgreSQL job queue is not available")
+        self.db_pool = DatabasePool(db_settings, size=pool_size)
+
+    def migrate(self):
+        """
+        Create the missing tables of the queue.
+        :return: nothing
+        """
+        created = self.db_pool.migrate(self.SCHEMA)
+        if created:
+            logging.info("Job queue schema updated: %s", ", ".join(created))
+
+    def append(self, text, created=None, priority=Spool.PRIORITY_NORMAL, topic=None, ttl=None, document=None):
+        created = created or time.time()
+        if ttl is None:
+            ttl = self.ttls.get(priority)
+
+        def append_message(conn, cur):
+            cur.execute("INSERT INTO job_messages(text, created, priority, expires, topic, document) "
+                        "VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+                        (text, created, priority, created + ttl if ttl else None, topic, document))
+            message_id = cur.fetchone()[0]
+            if topic is None:
+                cur.execute("INSERT INTO job_deliveries(message_id, chat_id, priority) "
+                            "SELECT %s, chat_id, %s FROM chats WHERE quarantined IS NULL",
+                            (message_id, priority))
+            else:
+                cur.execute("INSERT INTO job_deliveries(message_id, chat_id, priority) "
+                            "SELECT %s, c.chat_id, %s FROM chats c "
+                            "JOIN chat_topics t ON t.chat_id = c.chat_id "
+                            "WHERE t.topic = %s AND c.quarantined IS NULL",
+                            (message_id, priority, topic))
+            return message_id
+
+        message_id = self.db_pool.run(append_message)
+        self.new_message.set()
+        return message_id
+
+    def size(self):
+        def count(conn, cur):
+            cur.execute("SELECT COUNT(*) FROM job_messages")
+            return cur.fetchone()[0]
+        return self.db_pool.run(count)
+
+    def lanes(self):
+        def pending_lanes(conn, cur):
+            # Loose index scan, one probe of the index per lane
+            cur.execute("SELECT priority FROM (VALUES (%s), (%s), (%s)) AS lanes(priority) "
+                        "WHERE EXISTS (SELECT 1 FROM job_deliveries d "
+                        "WHERE d.priority = lanes.priority AND d.state = 'pending')",
+                        sorted(Spool.PRIORITIES.values()))
+            return [row[0] for row in cur.fetchall()]
+        return self.db_pool.run(pending_lanes)
+
+    def process(self, priority, limit, send):
+        def process_batch(conn, cur):
+            cur.execute("SELECT d.message_id, d.chat_id, m.text, m.created, m.document "
+                        "FROM job_deliveries d JOIN job_messages m ON m.id = d.message_id "
+                        "WHERE d.priority = %s AND d.state = 'pending' "
+                        "ORDER BY d.message_id LIMIT %s "
+                        "FOR UPDATE OF d SKIP LOCKED", (priority, limit))
+            rows = cur.fetchall()
+            messages = self.group(rows)
+
+            for message_id, (text, _, document, chat_ids) in messages.items():
+                summary = send(chat_ids, text, document)
+                delivered = [str(chat_id) for chat_id in summary['delivered'] + summary['retried']]
+                if delivered:
+                    cur.execute("DELETE FROM job_deliveries WHERE message_id = %s AND chat_id = ANY(%s)",
+                                (message_id, delivered))
+                if summary['failed']:
+                    cur.executemany("UPDATE job_deliveries SET state = 'failed', error = %s "
+                                    "WHERE message_id = %s AND chat_id = %s",
+                                    [(error, message_id, str(chat_id)) for chat_id, error in summary['failed']])
+
+            # Jobs locked by other workers are still pending for this transaction
+            completed = []
+            if messages:
+                cur.execute("DELETE FROM job_messages m WHERE m.id = ANY(%s) AND NOT EXISTS "
+                            "(SELECT 1 FROM job_deliveries d WHERE d.message_id = m.id AND d.state = 'pending') "
+                            "RETURNING m.id, m.created, m.document", (list(messages),))
+                completed = sorted(cur.fetchall())
+            return len(rows), completed
+
+        claimed, completed = self.db_pool.run(process_batch)
+        for _, _, document in completed:
+            DocumentSpool.remove(document)
+        return claimed, [(message_id, created) for message_id, created, _ in completed]
+
+    def expire(self, now=None):
+        def expire_messages(conn, cur):
+            cur.execute("DELETE FROM job_messages WHERE expires <= %s RETURNING id, document",
+                        (now or time.time(),))
+            expired = cur.fetchall()
+            # Messages without recipients, or completed by two workers at once, each one
+            # seeing the jobs of the other as pending
+            cur.execute("DELETE FROM job_messages m WHERE NOT EXISTS "
+                        "(SELECT 1 FROM job_deliveries d WHERE d.message_id = m.id AND d.state = 'pending') "
+                        "RETURNING m.id, m.document")
+            return expired, cur.fetchall()
+
+        expired, empty = self.db_pool.run(expire_messages)
+        for _, document in expired + empty:
+            DocumentSpool.remove(document)
+        return [message_id for message_id, _ in expired]
+
+    def close(self):
+        self.db_pool.close()
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue in the SQLite database, shared by the instances running on the same host.
+    A stand-in for PostgreSQL in small installations and tests: recipients are expanded by
+    the instance appending the message, and a claimed job is leased to the worker, so the jobs
+    of a worker which died are claimed again after the lease.
+    """
+    # Seconds a claimed job stays with the worker
+    LEASE = 300
+
+    def __init__(self, path, recipients, ttls=None):
+        super().__init__(ttls)
+        self.path = path
+        self.lock = threading.Lock()
+
+        # Function (topic) returning the recipients of the message
+        self.recipients = recipients
+
+        # Transactions are begun explicitly, claims must take the write lock first
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS job_messages ("
+                          " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                          " text TEXT NOT NULL,"
+                          " created REAL NOT NULL,"
+                          " priority INTEGER NOT NULL DEFAULT 1,"
+                          " expires REAL,"
+                          " topic TEXT,"
+                          " document TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS job_deliveries ("
+                          " message_id INTEGER NOT NULL,"
+                          " chat_id TEXT NOT NULL,"
+                          " priority INTEGER NOT NULL DEFAULT 1,"
+                          " state TEXT NOT NULL DEFAULT 'pending',"
+                          " leased REAL,"
+                          " error TEXT,"
+                          " PRIMARY KEY (message_id, chat_id))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS job_deliveries_state "
+                          "ON job_deliveries(priority, state, message_id)")
+        if 'document' not in [row[1] for row in self.conn.execute("PRAGMA table_info(job_messages)")]:
+            self.conn.execute("ALTER TABLE job_messages ADD COLUMN document TEXT")
+
+    def transaction(self, func):
+        """
+        Run the function in a write transaction.
+        :param func: function taking the connection, its result is returned
+        :return: result of the function
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self.conn)
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return result
+
+    def append(self, text, created=None, priority=Spool.PRIORITY_NORMAL, topic=None, ttl=None, document=None):
+        created = created or time.time()
+        if ttl is None:
+            ttl = self.ttls.get(priority)
+        chat_ids = self.recipients(topic)
+
+        def append_message(conn):
+            cur = conn.execute("INSERT INTO job_messages(text, created, priority, expires, topic, document) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (text, created, priority, created + ttl if ttl else None, topic, document))
+            conn.executemany("INSERT OR IGNORE INTO job_deliveries(message_id, chat_id, priority) "
+                             "VALUES (?, ?, ?)",
+                             ((cur.lastrowid, str(chat_id), priority) for chat_id in chat_ids))
+            return cur.lastrowid
+
+        message_id = self.transaction(append_message)
+        self.new_message.set()
+        return message_id
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM job_messages").fetchone()[0]
+
+    def lanes(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT priority FROM job_deliveries "
+                                                        "WHERE state='pending' OR "
+                                                        "(state='claimed' AND leased<=?)",
+                                                        (time.time(),))]
+
+    def process(self, priority, limit, send):
+        def claim(conn):
+            now = time.time()
+            rows = conn.execute("SELECT d.message_id, d.chat_id, m.text, m.created, m.document "
+                                "FROM job_deliveries d JOIN job_messages m ON m.id=d.message_id "
+                                "WHERE d.priority=? AND (d.state='pending' OR "
+                                "(d.state='claimed' AND d.leased<=?)) "
+                                "ORDER BY d.message_id LIMIT ?", (priority, now, limit)).fetchall()
+            conn.executemany("UPDATE job_deliveries SET state='claimed', leased=? "
+                             "WHERE message_id=? AND chat_id=?",
+                             ((now + self.LEASE, row[0], row[1]) for row in rows))
+            return rows
+
+        rows = self.transaction(claim)
+        messages = self.group(rows)
+        summaries = [(message_id, send(chat_ids, text, document), chat_ids)
+                     for message_id, (text, _, document, chat_ids) in messages.items()]
+
+        def save(conn):
+            for message_id, summary, chat_ids in summaries:
+                conn.executemany("DELETE FROM job_deliveries WHERE message_id=? AND chat_id=?",
+                                 ((message_id, str(chat_id))
+                                  for chat_id in summary['delivered'] + summary['retried']))
+                conn.executemany("UPDATE job_deliveries SET state='failed', error=? "
+                                 "WHERE message_id=? AND chat_id=?",
+                                 ((error, message_id, str(chat_id)) for chat_id, error in summary['failed']))
+                # Not sent because of the shutdown, left for other workers
+                conn.executemany("UPDATE job_deliveries SET state='pending', leased=NULL "
+                                 "WHERE message_id=? AND chat_id=? AND state='claimed'",
+                                 ((message_id, str(chat_id)) for chat_id in chat_ids))
+
+            completed = []
+            for message_id, (_, created, document, _) in messages.items():
+                if conn.execute("SELECT 1 FROM job_deliveries WHERE message_id=? "
+                                "AND state IN ('pending', 'claimed') LIMIT 1", (message_id,)).fetchone():
+                    continue
+                conn.execute("DELETE FROM job_deliveries WHERE message_id=?", (message_id,))
+                conn.execute("DELETE FROM job_messages WHERE id=?", (message_id,))
+                completed.append((message_id, created, document))
+            return completed
+
+        completed = self.transaction(save) if rows else []
+        for _, _, document in completed:
+            DocumentSpool.remove(document)
+        return len(rows), [(message_id, created) for message_id, created, _ in completed]
+
+    def expire(self, now=None):
+        def expire_messages(conn):
+            expired = conn.execute("SELECT id, document FROM job_messages WHERE expires<=?",
+                                   (now or time.time(),)).fetchall()
+            # Messages without recipients
+            empty = conn.execute("SELECT id, document FROM job_messages m WHERE NOT EXISTS "
+                                 "(SELECT 1 FROM job_deliveries d WHERE d.message_id=m.id "
+                                 "AND d.state IN ('pending', 'claimed'))").fetchall()
+            for message_id, _ in set(expired + empty):
+                conn.execute("DELETE FROM job_deliveries WHERE message_id=?", (message_id,))
+                conn.execute("DELETE FROM job_messages WHERE id=?", (message_id,))
+            return expired, empty
+
+        expired, empty = self.transaction(expire_messages)
+        for _, document in set(expired + empty):
+            DocumentSpool.remove(document)
+        return [message_id for message_id, _ in expired]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class DeliveryThread(threading.Thread):
+    """
+    Delivery thread, drains the spool and broadcasts the messages via Telegram.
+    Messages are sent in batches of chats, and the lane to take the next batch from is chosen
+    before every batch: the more urgent lane first (strict), or by the weights of the lanes
+    (weighted). So a critical message does not wait for the long broadcast of a bulk one.
+    With a shared job queue the thread is one of the workers claiming batches from it.
+    """
+    # Number of chats processed between checkpoints
+    BATCH_SIZE = 100
+
+    # Lane -> batches sent from it per round of the weighted scheduling
+    WEIGHTS = {Spool.PRIORITY_CRITICAL: 8,
+               Spool.PRIORITY_NORMAL: 4,
+               Spool.PRIORITY_BULK: 1}
+
+    def __init__(self, app, strict=False, weights=None):
+        super().__init__()
+
+        self.app = app
+
+        # Scheduling of the lanes
+        self.strict = strict
+        self.weights = weights or self.WEIGHTS
+
+        # Lane -> current credit of the lane, for the weighted scheduling
+        self.credits = {}
+
+        # Message ID -> [start time, delivered, failed], for messages being delivered
+        self.progress = {}
+
+    def choose_lane(self, lanes):
+        """
+        Choose the lane to send the next batch from. Weighted scheduling is smooth weighted
+        round robin, so the lanes are interleaved instead of served in long runs.
+        :param lanes: lanes having messages
+        :return: lane
+        """
+        if self.strict:
+            return min(lanes)
+
+        total = 0
+        for lane in lanes:
+            weight = self.weights.get(lane, 1)
+            self.credits[lane] = self.credits.get(lane, 0) + weight
+            total += weight
+        for lane in [lane for lane in self.credits if lane not in lanes]:
+            del self.credits[lane]
+
+        chosen = max(lanes, key=lambda lane: (self.credits[lane], -lane))
+        self.credits[chosen] -= total
+        return chosen
+
+    def deliver(self, message_id, text, expanded, created, topic=None, document=None):
+        """
+        Deliver the next batch of the message from the spool, completing the message if
+        all of its recipients are processed.
+        :param message_id: message ID
+        :param text: message text
+        :param expanded: True if the recipients of the message are already recorded
+        :param created: time the message was received
+        :param topic: topic of the message, None if it goes to all subscribers
+        :param document: path to the document to send, None for a text message
+        :return: nothing
+        """
+        spool = self.app.spool
+        if not expanded:
+            spool.expand(message_id, self.app.subscribers.recipients(topic))
+        progress = self.progress.setdefault(message_id, [time.time(), 0, 0])
+
+        chat_ids = spool.pending(message_id, self.BATCH_SIZE)
+        if chat_ids:
+            summary = self.app.fan_out(chat_ids, text, document)
+            spool.checkpoint(message_id, summary)
+            progress[1] += len(summary['delivered']) + len(summary['retried'])
+            progress[2] += len(summary['failed'])
+            return
+
+        spool.complete(message_id)
+        del self.progress[message_id]
+        METRICS.inc('sender_messages_delivered_total')
+        METRICS.observe('sender_delivery_seconds', time.time() - created)
+        logging.info("Message %d delivered in %.2f s: %d delivered, %d failed",
+                     message_id, time.time() - progress[0], progress[1], progress[2])
+
+    def deliver_jobs(self, lane):
+        """
+        Claim the next batch of jobs of the lane from the shared job queue and send it.
+        :param lane: priority lane
+        :return: number of jobs claimed
+        """
+        claimed, completed = self.app.spool.process(lane, self.BATCH_SIZE, self.app.fan_out)
+        for message_id, created in completed:
+            METRICS.inc('sender_messages_delivered_total')
+            METRICS.observe('sender_delivery_seconds', time.time() - created)
+            logging.info("Message %d delivered", message_id)
+        return claimed
+
+    def expire(self):
+        """
+        Drop the messages which outlived their TTL.
+        :return: nothing
+        """
+        expired = self.app.spool.expire()
+        for message_id in expired:
+            self.progress.pop(message_id, None)
+        if expired:
+            METRICS.inc('sender_messages_expired_total', len(expired))
+            logging.warning("%d stale messages expired", len(expired))
+
+    def run(self):
+        """
+        The 'run' function of the delivery thread, will deliver messages from the spool
+        until terminated.
+        :return: nothing
+        """
+        logging.info("Delivery thread started.")
+        spool = self.app.spool
+        last_expire = 0
+        while self.app.is_running:
+            try:
+                if time.monotonic() - last_expire >= 1:
+                    last_expire = time.monotonic()
+                    self.expire()
+
+                lanes = spool.lanes()
+                if not lanes:
+                    spool.new_message.wait(1)
+                    spool.new_message.clear()
+                    continue
+                if not isinstance(spool, JobQueue):
+                    self.deliver(*spool.next_message(self.choose_lane(lanes)))
+                elif not self.deliver_jobs(self.choose_lane(lanes)):
+                    # Jobs left in the lane are being sent by other workers
+                    spool.new_message.wait(0.1)
+                    spool.new_message.clear()
+            except Exception as e:
+                logging.error("Exception (delivery): %s", str(e))
+                time.sleep(1)
+
+        logging.info("Delivery thread terminated.")
+
+
+class CoalescerThread(threading.Thread):
+    """
+    Coalescing stage between ingest and the spool. Collects messages arriving in bursts during
+    the window (or until there are enough of them) and packs them into as few messages as fit
+    into the Telegram limit. Every packed message starts with a header with the count.
+    Messages of different lanes or topics are never packed together.
+    """
+    # Separator between packed messages
+    SEPARATOR = "\n\n"
+
+    def __init__(self, app, window, max_messages):
+        super().__init__()
+
+        self.app = app
+
+        # Seconds to wait after the first message of the burst, and maximum messages to wait for
+        self.window = window
+        self.max_messages = max_messages
+
+        # List of (priority, topic, text)
+        self.buffer = []
+        self.first_time = None
+        self.first_received = None
+        self.condition = threading.Condition()
+
+    def add(self, text, received=None, priority=Spool.PRIORITY_NORMAL, topic=None):
+        """
+        Add the message to the current burst.
+        :param text: message text
+        :param received: time the message was received (unix time), now if None
+        :param priority: priority lane of the message
+        :param topic: topic of the message
+        :return: nothing
+        """
+        with self.condition:
+            if not self.buffer:
+                self.first_time = time.monotonic()
+                self.first_received = received or time.time()
+            self.buffer.append((priority, topic, text))
+            self.condition.notify()
+
+    @classmethod
+    def pack(cls, messages, limit=MESSAGE_LIMIT):
+        """
+        Pack messages into as few texts as fit into the limit.
+        A message too long to be packed goes alone, as is.
+        :param messages: list of message texts
+        :param limit: maximum length of the packed text
+        :return: list of packed texts
+        """
+        if len(messages) == 1:
+            return list(messages)
+
+        groups = []
+        group = []
+        length = 0
+        # Room for the header, like "[999 messages]\n\n"
+        room = limit - 32
+        for text in messages:
+            added = len(text) + (len(cls.SEPARATOR) if group else 0)
+            if group and length + added > room:
+                groups.append(group)
+                group = []
+                added = len(text)
+                length = 0
+            group.append(text)
+            length += added
+        if group:
+            groups.append(group)
+
+        packed = []
+        for group in groups:
+            if len(group) == 1:
+                packed.append(group[0])
+            else:
+                packed.append("[" + str(len(group)) + " messages]" + cls.SEPARATOR +
+                              cls.SEPARATOR.join(group))
+        return packed
+
+    def flush(self):
+        """
+        Pack the collected messages of every lane and topic and put them to the spool.
+        :return: nothing
+        """
+        with self.condition:
+            messages = self.buffer
+            received = self.first_received
+            self.buffer = []
+            self.first_time = None
+        if not messages:
+            return
+
+        groups = collections.OrderedDict()
+        for priority, topic, text in sorted(messages, key=lambda message: message[0]):
+            groups.setdefault((priority, topic), []).append(text)
+        for (priority, topic), group in groups.items():
+            packed = self.pack(group)
+            logging.info("Coalesced %d messages into %d", len(group), len(packed))
+            for text in packed:
+                self.app.spool.append(text, received, priority, topic)
+
+    def run(self):
+        """
+        The 'run' function of the coalescer thread, flushes the bursts until terminated.
+        :return: nothing
+        """
+        logging.info("Coalescer thread started.")
+        while self.app.is_accepting:
+            with self.condition:
+                if not self.buffer:
+                    self.condition.wait(1)
+                    continue
+                remaining = self.first_time + self.window - time.monotonic()
+                if remaining > 0 and len(self.buffer) < self.max_messages:
+                    self.condition.wait(min(remaining, 1))
+                    continue
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error("Exception (coalescer): %s", str(e))
+                time.sleep(1)
+
+        # Nothing collected should be lost
+        self.flush()
+        logging.info("Coalescer thread terminated.")
+
+
+class DeduplicatorThread(threading.Thread):
+    """
+    Suppresses repeated messages. Messages are keyed by the topic and the hash of the text,
+    or the key supplied by the producer. Repeats within the window are dropped, and when the window
+    expires a summary "repeated N times" is sent instead.
+    Keys are kept in a bounded LRU store, so memory use does not depend on the number of
+    distinct messages.
+    """
+    def __init__(self, app, window, size):
+        super().__init__()
+
+        self.app = app
+
+        # Seconds a message suppresses its repeats, and maximum number of keys to keep
+        self.window = window
+        self.size = size
+
+        # key -> [expiration time, repeats, last repeated text, topic]
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.suppressed_total = 0
+        self.summaries_total = 0
+
+    def check(self, text, key=None, topic=None):
+        """
+        Check the message, counting it if it is a repeat.
+        :param text: message text
+        :param key: deduplication key from the producer, hash of the text if None
+        :param topic: topic of the message, the same text in other topic is not a repeat
+        :return: True if the message should be sent, False if it is a repeat
+        """
+        if key is None:
+            key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        # Keys come from JSON, and may be of any type
+        key = (topic, str(key))
+        now = time.monotonic()
+        evicted = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                entry[1] += 1
+                entry[2] = text
+                self.entries.move_to_end(key)
+                self.suppressed_total += 1
+                METRICS.inc('sender_duplicates_suppressed_total')
+                return False
+
+            if entry is not None:
+                del self.entries[key]
+                evicted = [entry]
+            self.entries[key] = [now + self.window, 0, None, topic]
+            if len(self.entries) > self.size:
+                evicted = (evicted or []) + [self.entries.popitem(last=False)[1]]
+
+        if evicted:
+            self.summarize(evicted)
+        return True
+
+    def summarize(self, entries):
+        """
+        Send the summaries for the entries which suppressed repeats.
+        :param entries: list of entries
+        :return: nothing
+        """
+        for _, repeats, text, topic in entries:
+            if repeats:
+                self.summaries_total += 1
+                METRICS.inc('sender_duplicate_summaries_total')
+                self.app.enqueue("[repeated " + str(repeats) + " more times] " + text, topic=topic)
+
+    def expire(self):
+        """
+        Remove the expired entries, sending the summaries.
+        :return: nothing
+        """
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[0] <= now]:
+                expired.append(self.entries.pop(key))
+        self.summarize(expired)
+
+    def flush(self):
+        """
+        Forget all entries, sending the summaries of the suppressed repeats.
+        :return: nothing
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        self.summarize(entries)
+
+    def stats(self):
+        """
+        Get the deduplication statistics.
+        :return: dict with 'keys', 'suppressed' and 'summaries'
+        """
+        return {'keys': len(self.entries),
+                'suppressed': self.suppressed_total,
+                'summaries': self.summaries_total}
+
+    def run(self):
+        """
+        The 'run' function of the deduplicator thread, expires the entries until terminated.
+        :return: nothing
+        """
+        logging.info("Deduplicator thread started.")
+        while self.app.is_accepting:
+            time.sleep(1)
+            try:
+                self.expire()
+            except Exception as e:
+                logging.error("Exception (deduplicator): %s", str(e))
+
+        logging.info("Deduplicator thread terminated, %d messages suppressed.",
+                     self.suppressed_total)
+
+
+class SubscriberRegistry:
+    """
+    In-memory registry of subscribers, keyed by the normalised chat ID (string, as stored
+    in the database). Keeps metadata of every subscriber: registration time, the bot serving
+    the chat, its topics and the delivery state: last delivery and its status, last success,
+    consecutive failures. Subscribers which are unreachable are quarantined, they stay
+    registered but receive nothing. Thread safe.
+    The index topic -> subscribers resolves recipients of a message without scanning
+    all subscribers.
+    """
+    # Topic names: letters, digits, "_", "-" and "."
+    TOPIC_PATTERN = re.compile(r'^[a-z0-9_.\-]{1,64}$')
+
+    def __init__(self, chat_ids=()):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+        # Topic -> set of subscribed chat IDs
+        self.topics = {}
+
+        for chat_id in chat_ids:
+            self.add(chat_id)
+
+    @staticmethod
+    def normalize(chat_id):
+        """
+        Normalise the chat ID, so IDs from Telegram (int) and the database (str) match.
+        :param chat_id: chat ID
+        :return: normalised chat ID
+        """
+        return str(chat_id).strip()
+
+    @classmethod
+    def normalize_topic(cls, topic):
+        """
+        Normalise the topic name.
+        :param topic: topic name
+        :return: normalised topic name, None if the name is not valid
+        """
+        topic = str(topic).strip().lower()
+        return topic if cls.TOPIC_PATTERN.match(topic) else None
+
+    def add(self, chat_id, registered_at=None, bot_id=None, quarantined=None, last_error=None):
+        """
+        Add the subscriber.
+        :param chat_id: chat ID
+        :param registered_at: registration time (unix time), now if None
+        :param bot_id: ID of the bot serving the chat, None if not known
+        :param quarantined: quarantine time (unix time), None if the subscriber is live
+        :param last_error: last delivery error
+        :return: True if added, False if it was there already
+        """
+        chat_id = self.normalize(chat_id)
+        with self.lock:
+            if chat_id in self.subscribers:
+                return False
+            self.subscribers[chat_id] = {'registered_at': registered_at or time.time(),
+                                         'bot_id': bot_id,
+                                         'topics': set(),
+                                         'last_delivery': None,
+                                         'last_status': None,
+                                         'last_error': last_error,
+                                         'last_success': None,
+                                         'failures': 0,
+                                         'unreachable': 0,
+                                         'quarantined': quarantined}
+            return True
+
+    def assign_bot(self, bot_id):
+        """
+        Set the bot of the subscribers which have none.
+        :param bot_id: bot ID
+        :return: number of subscribers changed
+        """
+        changed = 0
+        with self.lock:
+            for info in self.subscribers.values():
+                if info['bot_id'] is None:
+                    info['bot_id'] = bot_id
+                    changed += 1
+        return changed
+
+    def remove(self, chat_id):
+        """
+        Remove the subscriber.
+        :param chat_id: chat ID
+        :return: True if removed, False if there was no such subscriber
+        """
+        chat_id = self.normalize(chat_id)
+        with self.lock:
+            info = self.subscribers.pop(chat_id, None)
+            if info is None:
+                return False
+            for topic in info['topics']:
+                self.unindex(chat_id, topic)
+            return True
+
+    def sync(self, chat_id, bot_id=None, quarantined=None, last_error=None):
+        """
+        Apply the state of the subscriber changed elsewhere (another instance of the bot,
+        or by hand in the database), adding the subscriber if needed.
+        :param chat_id: chat ID
+        :param bot_id: ID of the bot serving the chat
+        :param quarantined: quarantine time (unix time), None if the subscriber is live
+        :param last_error: last delivery error
+        :return: True if the subscriber was added, False if updated
+        """
+        if self.add(chat_id, bot_id=bot_id, quarantined=quarantined, last_error=last_error):
+            return True
+        with self.lock:
+            info = self.subscribers.get(self.normalize(chat_id))
+            if info is not None:
+                if quarantined is None and info['quarantined'] is not None:
+                    info['unreachable'] = 0
+                elif quarantined is not None:
+                    info['last_error'] = last_error
+                info.update(bot_id=bot_id, quarantined=quarantined)
+        return False
+
+    def unindex(self, chat_id, topic):
+        """
+        Remove the chat from the index of the topic. Must be called with the lock held.
+        :param chat_id: normalised chat ID
+        :param topic: topic
+        :return: nothing
+        """
+        chat_ids = self.topics.get(topic)
+        if chat_ids is not None:
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self.topics[topic]
+
+    def subscribe(self, chat_id, topic):
+        """
+        Subscribe the subscriber to the topic.
+        :param chat_id: chat ID
+        :param topic: normalised topic name
+        :return: True if subscribed, False if it was subscribed already or is not a subscriber
+        """
+        chat_id = self.normalize(chat_id)
+        with self.lock:
+            info = self.subscribers.get(chat_id)
+            if info is None or topic in info['topics']:
+                return False
+            info['topics'].add(topic)
+            self.topics.setdefault(topic, set()).add(chat_id)
+            return True
+
+    def unsubscribe(self, chat_id, topic):
+        """
+        Unsubscribe the subscriber from the topic.
+        :param chat_id: chat ID
+        :param topic: normalised topic name
+        :return: True if unsubscribed, False if it was not subscribed
+        """
+        chat_id = self.normalize(chat_id)
+        with self.lock:
+            info = self.subscribers.get(chat_id)
+            if info is None or topic not in info['topics']:
+                return False
+            info['topics'].discard(topic)
+            self.unindex(chat_id, topic)
+            return True
+
+    def recipients(self, topic=None):
+        """
+        Get the recipients of the message, quarantined subscribers are skipped.
+        :param topic: topic of the message, None for all subscribers
+        :return: list of chat IDs
+        """
+        with self.lock:
+            chat_ids = self.subscribers if topic is None else self.topics.get(topic, ())
+            return [chat_id for chat_id in chat_ids
+                    if self.subscribers[chat_id]['quarantined'] is None]
+
+    def quarantined(self):
+        """
+        Get the quarantined subscribers.
+        :return: list of tuples (chat ID, quarantine time, last error), sorted by chat ID
+        """
+        with self.lock:
+            return sorted((chat_id, info['quarantined'], info['last_error'])
+                          for chat_id, info in self.subscribers.items()
+                          if info['quarantined'] is not None)
+
+    def restore(self, chat_id):
+        """
+        Lift the quarantine of the subscriber.
+        :param chat_id: chat ID
+        :return: True if restored, False if it was not quarantined
+        """
+        with self.lock:
+            info = self.subscribers.get(self.normalize(chat_id))
+            if info is None or info['quarantined'] is None:
+                return False
+            info.update(quarantined=None, failures=0, unreachable=0)
+            return True
+
+    def __contains__(self, chat_id):
+        return self.normalize(chat_id) in self.subscribers
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def snapshot(self):
+        """
+        Get the list of all subscribers, safe to use while the registry is being changed.
+        :return: list of chat IDs
+        """
+        with self.lock:
+            return list(self.subscribers)
+
+    def info(self, chat_id):
+        """
+        Get the metadata of the subscriber.
+        :param chat_id: chat ID
+        :return: copy of the metadata dict, None if there is no such subscriber
+        """
+        with self.lock:
+            info = self.subscribers.get(self.normalize(chat_id))
+            if info is None:
+                return None
+            info = dict(info)
+            info['topics'] = sorted(info['topics'])
+            return info
+
+    def record_delivery(self, summary, quarantine_after=0):
+        """
+        Update the delivery state of subscribers from the broadcast summary. Subscribers found
+        unreachable quarantine_after times in a row are quarantined.
+        :param summary: delivery summary, see Broadcaster.broadcast
+        :param quarantine_after: number of unreachable deliveries in a row, 0 to never quarantine
+        :return: list of tuples (chat ID, quarantine time, error) of newly quarantined subscribers
+        """
+        now = time.time()
+        unreachable = set(self.normalize(chat_id) for chat_id in summary.get('unreachable', ()))
+        quarantined = []
+        with self.lock:
+            for status in ('delivered', 'retried'):
+                for chat_id in summary[status]:
+                    info = self.subscribers.get(self.normalize(chat_id))
+                    if info is not None:
+                        info.update(last_delivery=now, last_status=status, last_error=None,
+                                    last_success=now, failures=0, unreachable=0)
+            for chat_id, error in summary['failed']:
+                chat_id = self.normalize(chat_id)
+                info = self.subscribers.get(chat_id)
+                if info is None:
+                    continue
+                info.update(last_delivery=now, last_status='failed', last_error=error,
+                            failures=info['failures'] + 1)
+                if chat_id not in unreachable:
+                    continue
+                info['unreachable'] += 1
+                if quarantine_after and info['unreachable'] >= quarantine_after and \
+                        info['quarantined'] is None:
+                    info['quarantined'] = now
+                    quarantined.append((chat_id, now, error))
+        return quarantined
+
+
+class ChatSyncThread(threading.Thread):
+    """
+    Keeps subscribers and their topics in sync with the PostgreSQL database when it is changed
+    by other instances of the bot or by hand. Changes come as notifications on a LISTEN connection
+    and are applied one by one. Notifications sent while the connection was down are
+    recovered by the delta reload of the rows with newer versions, done after every
+    reconnect and periodically. The table is never re-read as a whole.
+    """
+    # Versions are taken before the commit, so a change may become visible after a newer one.
+    # Delta reload reads this many versions back to pick such changes up.
+    VERSION_OVERLAP = 100
+
+    # Seconds to wait before reconnecting
+    RECONNECT_DELAY = 5
+
+    def __init__(self, app, interval, version=0):
+        super().__init__()
+
+        self.app = app
+
+        # Seconds between the delta reloads
+        self.interval = interval
+
+        # Version of the last change applied
+        self.version = version
+
+    def apply(self, chat_id, bot_id=None, quarantined=None, last_error=None, topic=None,
+              removed=False, source='notify'):
+        """
+        Apply one change to the subscribers.
+        :param chat_id: chat ID
+        :param bot_id: ID of the bot serving the chat
+        :param quarantined: quarantine time (unix time), None if the chat is live
+        :param last_error: last delivery error
+        :param topic: topic the chat subscribed to or unsubscribed from, None if the chat changed
+        :param removed: True if the chat (or its subscription to the topic) was removed
+        :param source: where the change came from, for metrics
+        :return: nothing
+        """
+        if topic is not None:
+            if removed and self.app.subscribers.unsubscribe(chat_id, topic):
+                logging.info("Chat %s unsubscribed from %s by another instance", str(chat_id), topic)
+            elif not removed and self.app.subscribers.subscribe(chat_id, topic):
+                logging.info("Chat %s subscribed to %s by another instance", str(chat_id), topic)
+        elif removed:
+            if self.app.subscribers.remove(chat_id):
+                logging.info("Chat %s removed by another instance", str(chat_id))
+        elif self.app.subscribers.sync(chat_id, bot_id, quarantined, last_error):
+            logging.info("Chat %s added by another instance", str(chat_id))
+        METRICS.inc('sender_sync_changes_total', source=source)
+
+    def reload(self):
+        """
+        Apply the changes made after the last applied version.
+        :return: nothing
+        """
+        changes = self.app.store.changes(max(0, self.version - self.VERSION_OVERLAP))
+        for version, chat_id, bot_id, quarantined, last_error, topic, removed in changes:
+            self.apply(chat_id, bot_id, quarantined, last_error, topic, removed, source='reload')
+            self.version = max(self.version, version)
+
+    def notified(self, payload):
+        """
+        Apply the change from the notification.
+        :param payload: notification payload, JSON
+        :return: nothing
+        """
+        try:
+            change = json.loads(payload)
+        except ValueError as e:
+            logging.warning("Bad change notification: %s", str(e))
+            return
+        self.apply(change['chat_id'], change.get('bot_id'), change.get('quarantined'),
+                   change.get('last_error'), change.get('topic'),
+                   change['op'] in ('remove', 'unsubscribe'))
+
+    def run(self):
+        """
+        The 'run' function of the sync thread, applies the changes until terminated.
+        :return: nothing
+        """
+        logging.info("Subscriber sync thread started.")
+        conn = None
+        next_reload = 0
+        while self.app.is_running:
+            try:
+                if conn is None:
+                    conn = self.app.store.listen()
+                    logging.info("Listening to the changes of subscribers")
+                    next_reload = 0
+
+                if time.monotonic() >= next_reload:
+                    self.reload()
+                    next_reload = time.monotonic() + self.interval
+
+                if select.select([conn], [], [], 1)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        self.notified(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logging.error("Exception (subscriber sync): %s", str(e))
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+                time.sleep(self.RECONNECT_DELAY)
+
+        if conn is not None:
+            conn.close()
+        logging.info("Subscriber sync thread terminated.")
+
+
+class TokenBucket:
+    """
+    Token bucket, allows 'rate' events per second with bursts up to 'capacity' events.
+    Thread safe.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token from the bucket, going into debt if the bucket is empty.
+        :return: time in seconds the caller should wait before using the token
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def is_full(self):
+        """
+        Check if the bucket is full, meaning it was not used for a while.
+        :return: True if the bucket is full
+        """
+        with self.lock:
+            tokens = self.tokens + (time.monotonic() - self.timestamp) * self.rate
+            return tokens >= self.capacity
+
+
+class CallCancelled(Exception):
+    """
+    Raised by RateLimiter when the call is given up because of the shutdown.
+    """
+
+
+class RateLimiter:
+    """
+    Shared scheduler for all Telegram API calls of the bot.
+    Keeps the bot within Telegram limits using a global token bucket and a bucket per chat,
+    honours 'retry_after' of the flood control errors and retries network errors with jittered
+    exponential backoff.
+    """
+    # Telegram limits: messages per second for the bot, per private chat, per group
+    GLOBAL_RATE = 30
+    CHAT_RATE = 1
+    GROUP_RATE = 20 / 60
+
+    # Backoff for network errors, seconds
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30
+
+    # Per chat buckets are cleaned up when there are more than this many of them
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, retries=2):
+        self.bot = bot
+
+        # How many times to retry the call after a network error
+        self.retries = retries
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.chat_buckets_lock = threading.Lock()
+
+        # Flood control from the server pauses all calls until this moment (time.monotonic)
+        self.paused_until = 0
+
+        # Set on shutdown, waiting calls give up instead of sleeping out the pauses
+        self.cancelled = threading.Event()
+
+    def chat_bucket(self, chat_id):
+        """
+        Get the bucket of the chat, creating it if needed.
+        Group chats have negative IDs and lower limits.
+        :param chat_id: chat ID
+        :return: TokenBucket
+        """
+        key = str(chat_id)
+        with self.chat_buckets_lock:
+            bucket = self.chat_buckets.get(key)
+            if bucket is None:
+                if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                    self.chat_buckets = {k: v for k, v in self.chat_buckets.items()
+                                         if not v.is_full()}
+                if key.startswith('-'):
+                    bucket = TokenBucket(self.GROUP_RATE, 1)
+                else:
+                    bucket = TokenBucket(self.CHAT_RATE, 1)
+                self.chat_buckets[key] = bucket
+            return bucket
+
+    def sleep(self, delay):
+        """
+        Sleep unless cancelled.
+        :param delay: seconds to sleep
+        :return: nothing
+        :raises: CallCancelled if cancelled before or during the sleep
+        """
+        if self.cancelled.wait(max(0, delay)):
+            raise CallCancelled()
+
+    def wait(self, chat_id):
+        """
+        Block until a call to the chat is allowed.
+        :param chat_id: chat ID
+        :return: nothing
+        :raises: CallCancelled if cancelled meanwhile
+        """
+        if self.cancelled.is_set():
+            raise CallCancelled()
+
+        delay = self.chat_bucket(chat_id).reserve()
+        if delay > 0:
+            self.sleep(delay)
+
+        delay = self.global_bucket.reserve()
+        if delay > 0:
+            self.sleep(delay)
+
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            self.sleep(delay)
+
+    def backoff(self, attempt):
+        """
+        Delay before the next retry after a network error, full jitter.
+        :param attempt: number of the failed attempt, starting from 0
+        :return: delay in seconds
+        """
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** attempt)))
+
+    def call(self, chat_id, method, **kwargs):
+        """
+        Call the bot API method for the chat within the limits.
+        :param chat_id: chat ID, passed to the method as 'chat_id'
+        :param method: bot method to call, for example bot.send_message
+        :param kwargs: method arguments
+        :return: tuple (result of the method, number of retries made)
+        :raises: the last error if all retries failed, CallCancelled if cancelled before the call
+        """
+        attempt = 0
+        retries = 0
+        while True:
+            self.wait(chat_id)
+            start_time = time.time()
+            try:
+                result = method(chat_id=chat_id, **kwargs)
+                METRICS.observe('sender_send_seconds', time.time() - start_time)
+                return result, retries
+            except RetryAfter as e:
+                # Flood control is not limited by retries, the server tells exactly when to come back
+                logging.warning("Flood control, pausing for %s s", str(e.retry_after))
+                METRICS.inc('sender_flood_control_total')
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning("Call to %s failed (%s), retrying in %.2f s",
+                                str(chat_id), str(e), delay)
+                METRICS.inc('sender_retries_total')
+                self.sleep(delay)
+                attempt += 1
+            retries += 1
+
+    def send_message(self, chat_id, text, **kwargs):
+        """
+        Drop-in replacement for bot.send_message, going through the limiter.
+        :param chat_id: chat ID
+        :param text: message text
+        :return: sent message
+        """
+        return self.call(chat_id, self.bot.send_message, text=text, **kwargs)[0]
+
+    def cancel(self):
+        """
+        Give up the calls waiting for their turn, calls in progress are finished.
+        :return: nothing
+        """
+        self.cancelled.set()
+
+
+class Broadcaster:
+    """
+    Concurrent delivery engine, sends one message to many chats at once using a bounded pool
+    of worker threads.
+    A document is uploaded once, to the first chat accepting it, and sent to the other chats
+    by the file ID Telegram gave it. File IDs are valid only for the bot which uploaded the file.
+    """
+    # Number of file IDs of uploaded documents to remember
+    FILE_IDS_SIZE = 100
+
+    # Parts of the error messages telling the bot can not write to the chat anymore
+    UNREACHABLE_ERRORS = ('chat not found',
+                          'bot was blocked',
+                          'bot was kicked',
+                          'user is deactivated',
+                          'group chat was deactivated',
+                          'bot is not a member',
+                          "bot can't initiate conversation")
+
+    def __init__(self, sender, workers=8):
+        # RateLimiter all sends go through
+        self.sender = sender
+
+        # Maximum number of messages being sent at the same time
+        self.workers = workers
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        # Set on shutdown, sends not started yet are skipped
+        self.cancelled = threading.Event()
+
+        # Path to the document -> file ID of the uploaded document
+        self.file_ids = collections.OrderedDict()
+        self.upload_lock = threading.Lock()
+
+    @classmethod
+    def is_unreachable(cls, error):
+        """
+        Check if the error means the chat will not accept messages from the bot anymore:
+        the user blocked the bot, the chat was deleted and so on. Invalid token errors do not
+        count, they are not the fault of the chat.
+        :param error: exception raised by the send
+        :return: True if the chat is unreachable
+        """
+        if not isinstance(error, (Unauthorized, BadRequest)):
+            return False
+        message = str(error).lower()
+        return any(part in message for part in cls.UNREACHABLE_ERRORS)
+
+    def send(self, chat_id, text, document=None):
+        """
+        Send the message to one chat.
+        :param chat_id: chat to send the message to
+        :param text: message text, the caption if the message is a document
+        :param document: file ID of the uploaded document to send, None for a text message
+        :return: tuple (status, error), status is 'delivered', 'retried', 'failed', 'unreachable'
+                 or 'skipped'
+        """
+        if self.cancelled.is_set():
+            return 'skipped', None
+        try:
+            if document is None:
+                _, retries = self.sender.call(chat_id, self.sender.bot.send_message, text=text)
+            else:
+                _, retries = self.sender.call(chat_id, self.sender.bot.send_document,
+                                              document=document, caption=text)
+        except CallCancelled:
+            return 'skipped', None
+        except Exception as e:
+            return ('unreachable' if self.is_unreachable(e) else 'failed'), str(e)
+        return ('delivered' if retries == 0 else 'retried'), None
+
+    def upload(self, chat_id, text, path):
+        """
+        Upload the document, sending it to one chat.
+        :param chat_id: chat to send the document to
+        :param text: caption of the document
+        :param path: path to the document
+        :return: tuple (status, error, file ID), see send; file ID is None if the upload failed
+        """
+        def send_document(chat_id, caption):
+            # Opened for every attempt, a failed one may leave the file read to the end
+            with open(path, 'rb') as document:
+                return self.sender.bot.send_document(chat_id=chat_id, document=document, caption=caption,
+                                                     filename=DocumentSpool.DOCUMENT_NAME)
+
+        if self.cancelled.is_set():
+            return 'skipped', None, None
+        try:
+            message, retries = self.sender.call(chat_id, send_document, caption=text)
+        except CallCancelled:
+            return 'skipped', None, None
+        except Exception as e:
+            return ('unreachable' if self.is_unreachable(e) else 'failed'), str(e), None
+        METRICS.inc('sender_documents_uploaded_total')
+        return ('delivered' if retries == 0 else 'retried'), None, message.document.file_id
+
+    @staticmethod
+    def record(summary, chat_id, status, error):
+        """
+        Record the result of the send in the summary.
+        :param summary: summary, see broadcast
+        :param chat_id: chat the message was sent to
+        :param status: status of the send, see send
+        :param error: error of the send
+        :return: nothing
+        """
+        if status == 'skipped':
+            return
+        METRICS.inc('sender_sends_total', result=status)
+        if status in ('failed', 'unreachable'):
+            logging.error("Failed to send message to %s: %s", str(chat_id), error)
+            METRICS.inc('sender_send_failures_total', chat_id=chat_id)
+            summary['failed'].append((chat_id, error))
+            if status == 'unreachable':
+                summary['unreachable'].append(chat_id)
+        else:
+            summary[status].append(chat_id)
+
+    def broadcast(self, chat_ids, text, document=None):
+        """
+        Send the message to all chats in chat_ids concurrently. A document not uploaded yet
+        is uploaded first, trying the chats one by one until one accepts it.
+        Never raises, every failure is recorded in the summary instead. Chats skipped because
+        of the shutdown, or left when the upload failed not by the fault of the chat, are not
+        in the summary, so they stay pending.
+        :param chat_ids: chats to send the message to
+        :param text: message text, the caption if the message is a document
+        :param document: path to the document to send, None for a text message
+        :return: summary, dict with 'delivered', 'retried', 'failed' and 'unreachable' lists.
+                 'failed' holds (chat_id, error) tuples, 'unreachable' holds the failed chats
+                 the bot can not write to anymore.
+        """
+        summary = {'delivered': [], 'retried': [], 'failed': [], 'unreachable': []}
+
+        chat_ids = list(chat_ids)
+        if document is not None:
+            with self.upload_lock:
+                file_id = self.file_ids.get(document)
+                while file_id is None and chat_ids and not self.cancelled.is_set():
+                    chat_id = chat_ids.pop(0)
+                    status, error, file_id = self.upload(chat_id, text, document)
+                    self.record(summary, chat_id, status, error)
+                    if status == 'failed':
+                        # Not the fault of the chat, the others are left to the next attempt
+                        return summary
+                if file_id is not None:
+                    self.file_ids[document] = file_id
+                    self.file_ids.move_to_end(document)
+                    if len(self.file_ids) > self.FILE_IDS_SIZE:
+                        self.file_ids.popitem(last=False)
+            if file_id is None:
+                return summary
+            document = file_id
+
+        futures = {}
+        for chat_id in chat_ids:
+            futures[self.executor.submit(self.send, chat_id, text, document)] = chat_id
+
+        for future in concurrent.futures.as_completed(futures):
+            status, error = future.result()
+            self.record(summary, futures[future], status, error)
+
+        return summary
+
+    def cancel(self):
+        """
+        Skip the sends not started yet and give up the ones paused by the limits, sends
+        in progress are finished.
+        :return: nothing
+        """
+        self.cancelled.set()
+        self.sender.cancel()
+
+    def stop(self):
+        """
+        Stop the worker threads, waiting for sends in progress.
+        :return: nothing
+        """
+        self.executor.shutdown(wait=True)
+
+
+class Shard:
+    """
+    One of the bots the subscribers are spread over: Telegram updater with its own rate limiter
+    and sender workers. Telegram limits are per bot, so every shard adds to the throughput.
+    """
+    def __init__(self, token, workers=8, global_rate=RateLimiter.GLOBAL_RATE, retries=2,
+                 base_url=None):
+        self.token = token
+
+        # Bot ID is the first part of the token, it does not change when tokens are reordered
+        self.bot_id = token.split(':')[0]
+
+        # Connection pool should be big enough for all the parallel sends
+        self.updater = Updater(token=token, base_url=base_url,
+                               request_kwargs={'con_pool_size': workers + 4})
+        self.sender = RateLimiter(self.updater.bot, global_rate=global_rate, retries=retries)
+        self.broadcaster = Broadcaster(self.sender, workers=workers)
+
+
+class ConsoleThread(threading.Thread):
+    """
+    Console thread, lets the bot be stopped by writing 'q' when it runs in a terminal.
+    """
+    def __init__(self, app):
+        super().__init__(daemon=True)
+
+        self.app = app
+
+    def run(self):
+        """
+        The 'run' function of the console thread, reads commands until 'q' or the end of input.
         :return: nothing
         """
-        logging.info("TCPServer thread started.")
-        # Creating TCP server
-        try:
-            tcp_server = socketserver.TCPServer((self.app.host, self.app.port), MyTCPRequestHandler)
-        except Exception as e:
-            logging.critical("Failed to sttart the server, error: %s", str(e))
-            self.app.shutdown()
-            self.app.is_running = False
-        tcp_server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        tcp_server.socket.settimeout(1)
-
-        while self.app.is_running:
-            tcp_server.handle_request()
-
-        logging.info("TCPServer thread terminated.")
+        for line in sys.stdin:
+            if line.strip() == 'q':
+                logging.info("Terminating the program!")
+                self.app.stop()
+                return
 
 
 class Application:
@@ -101,10 +3219,37 @@ class Application:
     LOG_INFO = 3
     LOG_DEBUG = 4
 
+    # Results of the message ingest
+    INGEST_ACCEPTED = 'accepted'
+    INGEST_EMPTY = 'empty'
+    INGEST_BUSY = 'busy'
+    INGEST_DUPLICATE = 'duplicate'
+    INGEST_BAD_PRIORITY = 'bad_priority'
+    INGEST_BAD_TOPIC = 'bad_topic'
+
+    # Number of users on one page of /users
+    USERS_PAGE_SIZE = 100
+
+    # Long polling timeout of getUpdates, seconds. Stopping the bot waits for it (plus the
+    # read latency of the library), so it is kept well below the docker stop timeout
+    POLL_TIMEOUT = 3
+
     def __init__(self):
         # While True, the programm will be running
         self.is_running = True
 
+        # While True, new messages are accepted
+        self.is_accepting = True
+
+        # Set when the shutdown is requested
+        self.stop_requested = threading.Event()
+
+        # Seconds to deliver the queued messages on shutdown, the rest stays in the spool
+        self.drain_timeout = 5
+
+        # Time (time.monotonic) the shutdown has to be done by, None until it starts
+        self.shutdown_deadline = None
+
         # Verbosity level
         self.verbose = self.LOG_INFO
 
@@ -112,11 +3257,37 @@ class Application:
         self.host = '127.0.0.1'
         self.port = 16001
 
+        # Producer connections limits: number of connections handled at the same time,
+        # read timeout in seconds and maximum message size in bytes
+        self.max_connections = 32
+        self.read_timeout = 10
+        self.max_message_size = 65536
+
+        # Directory for messages too long for a text message, sent as documents,
+        # and maximum size of the message sent to the TCP port in bytes
+        self.documents_path = 'sender_bot_documents'
+        self.max_document_size = 20 * 1024 * 1024
+        self.documents = None
+
+        # Port for the framed protocol, 0 to disable, and its idle timeout in seconds
+        self.framed_port = 0
+        self.framed_idle_timeout = 300
+
+        # Port for the HTTP ingest API, 0 to disable, and maximum request body in bytes
+        self.http_port = 0
+        self.http_max_body = 1048576
+
         # If true, will print users from the database on screen during startup.
         self.print_users_from_db = True
 
         self.token = ''
 
+        # All bot tokens, subscribers are spread over the bots
+        self.tokens = []
+        self.shards = []
+        self.shards_by_bot = {}
+        self.shard_executor = None
+
         # Secret word to register the user permanently.
         self.secret_word = 'password'
 
@@ -127,20 +3298,94 @@ class Application:
                             'db_user': 'sender_bot',
                             'db_pass': 'password'}
 
-        # Chat IDs are stored here
-        self.chat_ids = []
+        # Database connection pool and its size
+        self.db_pool_size = 4
+
+        # Subscriber storage: 'postgres' or 'sqlite', and path to the SQLite database
+        self.storage = 'postgres'
+        self.sqlite_path = 'sender_bot.db'
+        self.store = None
+
+        # File to import chat IDs from, the bot exits after the import
+        self.import_file = None
+
+        # Subscribers are stored here
+        self.subscribers = SubscriberRegistry()
+
+        # Subscribers unreachable this many deliveries in a row are quarantined, 0 to disable
+        self.quarantine_after = 3
+
+        # Seconds between delta reloads of subscribers changed elsewhere (PostgreSQL only),
+        # 0 to disable the sync, and version of the subscribers loaded at start
+        self.sync_interval = 60
+        self.sync_version = 0
+
+        # Number of messages sent to Telegram at the same time during the broadcast
+        self.send_workers = 8
+
+        # How many times to retry the failed send
+        self.send_retries = 2
 
-        # Telegram updater and dispatcher
+        # Maximum messages per second for the bot
+        self.global_rate = RateLimiter.GLOBAL_RATE
+
+        # Telegram updater and dispatcher of the first bot
         self.updater = None
         self.dispatcher = None
 
+        # Rate limiter and delivery engine of the first bot
+        self.sender = None
+        self.broadcaster = None
+
+        # Path to the outbound spool database
+        self.spool_path = 'sender_bot_spool.db'
+        self.spool = None
+
+        # Where the messages wait for delivery: 'local' spool of this instance, or the job queue
+        # shared by several instances, 'postgres' next to the chats or 'sqlite' on the same host
+        self.queue = 'local'
+        self.queue_path = 'sender_bot_queue.db'
+
+        # Role of this instance: 'all', 'ingest' only accepts messages and commands,
+        # 'worker' only delivers messages from the shared job queue
+        self.mode = 'all'
+
+        # New messages are rejected while the spool holds this many undelivered messages,
+        # critical ones are always accepted
+        self.max_queue = 10000
+
+        # Scheduling of the priority lanes: 'weighted' or 'strict', weights of the lanes
+        # (critical, normal, bulk), and TTL of bulk messages in seconds (0 to keep them forever)
+        self.scheduling = 'weighted'
+        self.lane_weights = [DeliveryThread.WEIGHTS[Spool.PRIORITY_CRITICAL],
+                             DeliveryThread.WEIGHTS[Spool.PRIORITY_NORMAL],
+                             DeliveryThread.WEIGHTS[Spool.PRIORITY_BULK]]
+        self.bulk_ttl = 0
+
+        # Coalescing of bursts: window in seconds (0 to disable) and maximum messages in a burst
+        self.coalesce_window = 0
+        self.coalesce_max = 100
+        self.coalescer = None
+
+        # Suppression of repeated messages: window in seconds (0 to disable) and maximum keys
+        self.dedup_window = 0
+        self.dedup_size = 10000
+        self.deduplicator = None
+
+        # Port for the metrics HTTP server, 0 to disable
+        self.metrics_port = 0
+
+        # Threads started by start_threads
+        self.threads = []
+
     def stop_polling(self):
         """
         Stop polling.
         :return: nothing
         """
         logging.info("Stopping poller now!")
-        self.updater.stop()
+        for shard in self.shards:
+            shard.updater.stop()
 
     def sigint_handler(self, sig, tim):
         """
@@ -150,7 +3395,7 @@ class Application:
                 :return:  nothing
                 """
         logging.info("SIGINT received!")
-        self.shutdown()
+        self.stop()
 
     def sigterm_handler(self, sig, tim):
         """
@@ -160,150 +3405,234 @@ class Application:
         :return:  nothing
         """
         logging.info("SIGTERM received!")
-        self.shutdown()
+        self.stop()
+
+    def stop(self):
+        """
+        Request the shutdown, the main thread will do it. Safe to call from signal handlers
+        and other threads.
+        :return: nothing
+        """
+        self.stop_requested.set()
 
     @staticmethod
-    def load_chat_ids_from_database(db_settings):
+    def load_chat_ids_from_database(store):
         """
         Load chat_ids from the database
-        :param db_settings: database settings
-        :return: chat_ids, list. Empty if error.
+        :param store: subscriber storage
+        :return: list of tuples (chat_id, bot_id, quarantined, last_error). None if error.
         """
-        # Connect
-        try:
-            conn = psycopg2.connect(dbname=db_settings['db_name'],
-                                    host=db_settings['db_host'],
-                                    user=db_settings['db_user'],
-                                    port=db_settings['db_port'],
-                                    password=db_settings['db_pass'])
-        except Exception as e:
-            logging.error("Exception (load_chat_ids_from_database connect): %s", str(e))
-            return []
-
-        # Query
-        cur = conn.cursor()
-        sql_query = "SELECT chat_id FROM chats"
         try:
-            cur.execute(sql_query)
-            rows = cur.fetchall()
+            return store.load()
         except Exception as e:
             logging.error("Exception (load_chat_ids_from_database query): %s", str(e))
-            return []
+            return None
 
-        # Close
+    @staticmethod
+    def assign_bot_in_database(store, bot_id):
+        """
+        Set the bot of the chats which have none in the database.
+        :param store: subscriber storage
+        :param bot_id: bot ID
+        :return: 0 if OK, error code if not
+        """
         try:
-            cur.close()
-            conn.close()
+            store.assign_bot(bot_id)
         except Exception as e:
-            logging.error("Exception (load_chat_ids_from_database close): %s", str(e))
-            return []
+            logging.error("Exception (assign_bot_in_database query): %s", str(e))
+            return 2
 
         # Return
-        result = []
-        for row in rows:
-            result.append(row[0])
-
-        return result
+        return 0
 
     @staticmethod
-    def save_chat_ids_to_database(db_settings, chat_ids):
+    def save_chat_id_to_database(store, chat_id, bot_id=None):
         """
-        Update chat_ids in the database.
-        :param db_settings: database settings
-        :param chat_ids: chat_ids to be updated, list.
+        Add one chat_id to the database, updating its bot if it is there already.
+        :param store: subscriber storage
+        :param chat_id: chat_id to add
+        :param bot_id: ID of the bot serving the chat
         :return: 0 if OK, error code if not
         """
-        # Connect
         try:
-            conn = psycopg2.connect(dbname=db_settings['db_name'],
-                                    host=db_settings['db_host'],
-                                    user=db_settings['db_user'],
-                                    port=db_settings['db_port'],
-                                    password=db_settings['db_pass'])
+            store.add(chat_id, bot_id)
         except Exception as e:
-            logging.error("Exception (save_chat_ids_to_database connect) %s:", str(e))
-            return 1
-
-        # Query
-        cur = conn.cursor()
-        sql_query = "INSERT INTO chats(chat_id) VALUES"
+            logging.error("Exception (save_chat_id_to_database query): %s", str(e))
+            return 2
 
-        for i in range(0, len(chat_ids)-1):
-            sql_query += "('" + str(chat_ids[i]) + "'),"
-        sql_query += "('" + str(chat_ids[-1]) + "')"
+        # Return
+        return 0
 
-        sql_query += " ON CONFLICT DO NOTHING"
+    @staticmethod
+    def save_chat_ids_to_database(store, chat_ids):
+        """
+        Bulk import of chat_ids to the database, existing ones are skipped.
+        Used for migration of large subscriber lists, rows are sent in batches.
+        :param store: subscriber storage
+        :param chat_ids: chat_ids to be imported, list.
+        :return: 0 if OK, error code if not
+        """
+        if not chat_ids:
+            return 0
 
         try:
-            cur.execute(sql_query)
+            store.bulk_add(chat_ids)
         except Exception as e:
             logging.error("Exception (save_chat_ids_to_database query): %s", str(e))
             return 2
 
-        # Close
+        # Return
+        return 0
+
+    @staticmethod
+    def quarantine_chat_id_in_database(store, chat_id, quarantined=None, error=None):
+        """
+        Quarantine chat_id in the database, or lift its quarantine.
+        :param store: subscriber storage
+        :param chat_id: chat_id to quarantine
+        :param quarantined: quarantine time (unix time), None to lift the quarantine
+        :param error: error which made the chat quarantined
+        :return: 0 if OK, error code if not
+        """
         try:
-            conn.commit()
-            cur.close()
-            conn.close()
+            store.set_quarantine(chat_id, quarantined, error)
         except Exception as e:
-            logging.error("Exception (save_chat_ids_to_database close): %s", str(e))
-            return 3
+            logging.error("Exception (quarantine_chat_id_in_database query): %s", str(e))
+            return 2
 
         # Return
         return 0
 
     @staticmethod
-    def delete_chat_id_from_database(db_settings, chat_id):
+    def load_topics_from_database(store):
         """
-        Delete chat_id from the database.
-        :param db_settings: database settings
-        :param chat_id: chat_id to delete
+        Load topic subscriptions from the database
+        :param store: subscriber storage
+        :return: list of tuples (chat_id, topic). None if error.
+        """
+        try:
+            return store.load_topics()
+        except Exception as e:
+            logging.error("Exception (load_topics_from_database query): %s", str(e))
+            return None
+
+    @staticmethod
+    def save_topic_to_database(store, chat_id, topic):
+        """
+        Subscribe chat_id to the topic in the database.
+        :param store: subscriber storage
+        :param chat_id: chat_id to subscribe
+        :param topic: topic
         :return: 0 if OK, error code if not
         """
-        # Connect
         try:
-            conn = psycopg2.connect(dbname=db_settings['db_name'],
-                                    host=db_settings['db_host'],
-                                    user=db_settings['db_user'],
-                                    port=db_settings['db_port'],
-                                    password=db_settings['db_pass'])
+            store.add_topic(chat_id, topic)
         except Exception as e:
-            logging.error("Exception (delete_chat_id_from_database connect): %s", str(e))
-            return 1
+            logging.error("Exception (save_topic_to_database query): %s", str(e))
+            return 2
 
-        # Query
-        cur = conn.cursor()
-        sql_query = "DELETE FROM chats WHERE chat_id='"+chat_id+"'"
+        # Return
+        return 0
 
+    @staticmethod
+    def delete_topic_from_database(store, chat_id, topic):
+        """
+        Unsubscribe chat_id from the topic in the database.
+        :param store: subscriber storage
+        :param chat_id: chat_id to unsubscribe
+        :param topic: topic
+        :return: 0 if OK, error code if not
+        """
         try:
-            cur.execute(sql_query)
+            store.remove_topic(chat_id, topic)
         except Exception as e:
-            logging.error("Exception (delete_chat_id_from_database query): %s", str(e))
+            logging.error("Exception (delete_topic_from_database query): %s", str(e))
             return 2
 
-        # Close
+        # Return
+        return 0
+
+    @staticmethod
+    def delete_chat_id_from_database(store, chat_id):
+        """
+        Delete chat_id from the database.
+        :param store: subscriber storage
+        :param chat_id: chat_id to delete
+        :return: 0 if OK, error code if not
+        """
         try:
-            conn.commit()
-            cur.close()
-            conn.close()
+            store.remove(chat_id)
         except Exception as e:
-            logging.error("Exception (delete_chat_id_from_database close): %s", str(e))
-            return 3
+            logging.error("Exception (delete_chat_id_from_database query): %s", str(e))
+            return 2
 
         # Return
         return 0
 
     def shutdown(self):
         """
-        Initiate shutdown. This will stop the bot.
+        Shut the bot down: stop polling and accepting messages, deliver the queued ones until
+        the drain timeout, and leave the rest in the spool for the next start.
         :return: nothing
         """
-        self.broadcast("The bot is terminated!")
-        self.updater.stop()
-        self.updater.is_idle = False
+        logging.info("Shutting down, delivering queued messages for up to %.1f s", self.drain_timeout)
+        deadline = time.monotonic() + self.drain_timeout
+        self.shutdown_deadline = deadline
 
-    @staticmethod
-    def start(bot, update):
+        # Stopping the pollers waits for the long polling, done while draining
+        stoppers = [threading.Thread(target=shard.updater.stop, daemon=True)
+                    for shard in self.shards if self.mode != 'worker']
+        for stopper in stoppers:
+            stopper.start()
+
+        # Goes ahead of other messages, and is dropped if not delivered until the deadline.
+        # Instances sharing the job queue come and go, the others keep serving
+        if self.mode == 'all' and self.queue == 'local':
+            self.spool.append("The bot is terminated!", priority=Spool.PRIORITY_CRITICAL,
+                              ttl=self.drain_timeout)
+
+        self.join_threads(deadline)
+        for stopper in stoppers:
+            stopper.join(max(0, deadline - time.monotonic()))
+        if any(stopper.is_alive() for stopper in stoppers):
+            logging.warning("Polling did not stop until the deadline")
+
+    def shard_for_bot(self, bot):
+        """
+        Find the shard of the bot.
+        :param bot: the telegram bot
+        :return: Shard, the first one if the bot is unknown
+        """
+        for shard in self.shards:
+            if shard.updater.bot is bot:
+                return shard
+        return self.shards[0]
+
+    def shard_for_chat(self, chat_id):
+        """
+        Find the shard serving the chat: the bot the chat registered with, or the first one
+        if that is not known. A bot can not write to a user who never started it, so chats
+        of unknown bot are never spread over the others.
+        :param chat_id: chat ID
+        :return: Shard
+        """
+        info = self.subscribers.subscribers.get(SubscriberRegistry.normalize(chat_id))
+        if info is not None and info['bot_id'] in self.shards_by_bot:
+            return self.shards_by_bot[info['bot_id']]
+        return self.shards[0]
+
+    def reply(self, bot, update, text):
+        """
+        Answer the command via the bot which received it.
+        :param bot: the telegram bot
+        :param update: telegram update message
+        :param text: answer text
+        :return: nothing
+        """
+        self.shard_for_bot(bot).sender.send_message(chat_id=update.message.chat_id,
+                                                    text=text)
+
+    def start(self, bot, update):
         """
         Process /start command.
         Just greet the user, hinting him to use the SecretWord.
@@ -314,8 +3643,7 @@ class Application:
         logging.info("Command: /start from %s", str(update.message.chat_id))
 
         logging.info("Recorded user ID: %s", str(update.message.chat_id))
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Just say the word...")
+        self.reply(bot, update, "Just say the word...")
 
     def register(self, bot, update):
         """
@@ -327,15 +3655,23 @@ class Application:
         """
         logging.info("Command: /register from %s", str(update.message.chat_id))
 
-        self.chat_ids.append(update.message.chat_id)
-        result = self.save_chat_ids_to_database(self.db_settings, self.chat_ids)
+        chat_id = SubscriberRegistry.normalize(update.message.chat_id)
+        if chat_id in self.subscribers:
+            # The user who blocked the bot came back
+            if self.subscribers.restore(chat_id):
+                self.quarantine_chat_id_in_database(self.store, chat_id)
+                logging.info("Chat %s is back, quarantine lifted", chat_id)
+            self.reply(bot, update, "You are already in the broadcast list.")
+            return
+
+        bot_id = self.shard_for_bot(bot).bot_id
+        result = self.save_chat_id_to_database(self.store, chat_id, bot_id)
         if result != 0:
-            bot.send_message(chat_id=update.message.chat_id,
-                             text="Failed to add you to the broadcast list. Error code: " +
-                             str(result))
+            self.reply(bot, update, "Failed to add you to the broadcast list. Error code: " +
+                                    str(result))
         else:
-            bot.send_message(chat_id=update.message.chat_id,
-                             text="You are added to the broadcast list.")
+            self.subscribers.add(chat_id, bot_id=bot_id)
+            self.reply(bot, update, "You are added to the broadcast list.")
 
     def forget(self, bot, update):
         """
@@ -346,61 +3682,270 @@ class Application:
         :return: nothing
         """
         # Silently ignoring if the user is not registered
-        if not str(update.message.chat_id) in self.chat_ids:
+        if update.message.chat_id not in self.subscribers:
             return
 
         logging.info("Command: /forget from %s", str(update.message.chat_id))
 
-        chat_id = str(update.message.chat_id)
-        self.chat_ids.remove(chat_id)
+        chat_id = SubscriberRegistry.normalize(update.message.chat_id)
+        self.subscribers.remove(chat_id)
+
+        result = self.delete_chat_id_from_database(self.store, chat_id)
+
+        if result != 0:
+            self.reply(bot, update, "Failed to delete you from the broadcast list. Error code: " +
+                                    str(result))
+        else:
+            self.reply(bot, update, "You are deleted from the broadcast list.")
+
+    def subscribe(self, bot, update, args=None):
+        """
+        Process the /subscribe command.
+        "/subscribe TOPIC" subscribes the user to the topic, "/subscribe" lists the topics
+        of the user.
+        :param bot: the telegram bot
+        :param update: telegram update message
+        :param args: command arguments
+        :return: nothing
+        """
+        # Silently ignoring if the user is not registered
+        if update.message.chat_id not in self.subscribers:
+            return
+
+        logging.info("Command: /subscribe from %s", str(update.message.chat_id))
+
+        chat_id = SubscriberRegistry.normalize(update.message.chat_id)
+        if not args:
+            topics = self.subscribers.info(chat_id)['topics']
+            self.reply(bot, update, "Your topics: " + (", ".join(topics) if topics else "none") +
+                                    ". Use /subscribe TOPIC to subscribe to the topic.")
+            return
+
+        topic = SubscriberRegistry.normalize_topic(args[0])
+        if topic is None:
+            self.reply(bot, update, "Topic may have only letters, digits, '_', '-' and '.'.")
+            return
+
+        result = self.save_topic_to_database(self.store, chat_id, topic)
+        if result != 0:
+            self.reply(bot, update, "Failed to subscribe you to the topic. Error code: " +
+                                    str(result))
+        else:
+            self.subscribers.subscribe(chat_id, topic)
+            self.reply(bot, update, "You are subscribed to the topic " + topic + ".")
+
+    def unsubscribe(self, bot, update, args=None):
+        """
+        Process the /unsubscribe TOPIC command.
+        :param bot: the telegram bot
+        :param update: telegram update message
+        :param args: command arguments
+        :return: nothing
+        """
+        # Silently ignoring if the user is not registered
+        if update.message.chat_id not in self.subscribers:
+            return
+
+        logging.info("Command: /unsubscribe from %s", str(update.message.chat_id))
 
-        result = self.delete_chat_id_from_database(self.db_settings, chat_id)
+        chat_id = SubscriberRegistry.normalize(update.message.chat_id)
+        topic = SubscriberRegistry.normalize_topic(args[0]) if args else None
+        if topic is None or topic not in self.subscribers.info(chat_id)['topics']:
+            self.reply(bot, update, "You are not subscribed to this topic.")
+            return
 
+        result = self.delete_topic_from_database(self.store, chat_id, topic)
         if result != 0:
-            bot.send_message(chat_id=update.message.chat_id,
-                             text="Failed to delete you from the broadcast list. Error code: " +
-                             str(result))
+            self.reply(bot, update, "Failed to unsubscribe you from the topic. Error code: " +
+                                    str(result))
         else:
-            bot.send_message(chat_id=update.message.chat_id,
-                             text="You are deleted from the broadcast list.")
+            self.subscribers.unsubscribe(chat_id, topic)
+            self.reply(bot, update, "You are unsubscribed from the topic " + topic + ".")
+
+    def quarantine(self, bot, update, args=None):
+        """
+        Process the /quarantine command.
+        It will print the quarantined chats with their last errors.
+        "/quarantine restore CHAT_ID" lifts the quarantine of the chat, "/quarantine restore all"
+        of all chats.
+        :param bot: the telegram bot
+        :param update: telegram update message
+        :param args: command arguments
+        :return: nothing
+        """
+        # Silently ignoring if the user is not registered
+        if update.message.chat_id not in self.subscribers:
+            return
+
+        logging.info("Command: /quarantine from %s", str(update.message.chat_id))
 
-    def users(self, bot, update):
+        if args and args[0] == 'restore':
+            if len(args) < 2:
+                self.reply(bot, update, "Use /quarantine restore CHAT_ID or /quarantine restore all.")
+                return
+            if args[1] == 'all':
+                chat_ids = [chat_id for chat_id, _, _ in self.subscribers.quarantined()]
+            else:
+                chat_ids = [SubscriberRegistry.normalize(args[1])]
+            restored = 0
+            for chat_id in chat_ids:
+                if self.subscribers.restore(chat_id):
+                    self.quarantine_chat_id_in_database(self.store, chat_id)
+                    restored += 1
+            logging.info("Quarantine lifted for %d chats", restored)
+            self.reply(bot, update, "Restored chats: " + str(restored))
+            return
+
+        quarantined = self.subscribers.quarantined()
+        lines = ["Quarantined chats: " + str(len(quarantined))]
+        for chat_id, since, error in quarantined:
+            lines.append(" " + chat_id + " since " +
+                         time.strftime('%Y-%m-%d %H:%M', time.localtime(since)) + ": " + str(error))
+        if quarantined:
+            lines.append("Use /quarantine restore CHAT_ID or /quarantine restore all to restore.")
+
+        for part in split_message("\n".join(lines)):
+            self.reply(bot, update, part)
+
+    def users(self, bot, update, args=None):
         """
         Process the /users command.
-        It will print the chat_ids of currently registered users.
+        It will print the chat_ids of currently registered users, page by page.
+        "/users N" shows page N, "/users count" shows only the number of users.
         :param bot: the telegram bot
         :param update: telegram update message
+        :param args: command arguments
         :return: nothing
         """
         # Silently ignoring if the user is not registered
-        if not str(update.message.chat_id) in self.chat_ids:
+        if update.message.chat_id not in self.subscribers:
             return
 
         logging.info("Command: /users from %s", str(update.message.chat_id))
 
-        send_string = "Current saved subscribers of the channel:\n"
-        subscribers = self.load_chat_ids_from_database(self.db_settings)
+        subscribers = sorted(self.subscribers.snapshot())
+        if args and args[0] == 'count':
+            self.reply(bot, update, "Current saved subscribers of the channel: " +
+                                    str(len(subscribers)))
+            return
+
+        try:
+            page = int(args[0]) if args else 1
+        except ValueError:
+            page = 1
+        pages = max(1, (len(subscribers) + self.USERS_PAGE_SIZE - 1) // self.USERS_PAGE_SIZE)
+        page = min(max(page, 1), pages)
 
-        for line in subscribers:
-            send_string += " " + str(line) + "\n"
+        lines = ["Current saved subscribers of the channel (page " + str(page) + " of " +
+                 str(pages) + ", " + str(len(subscribers)) + " total):"]
+        start = (page - 1) * self.USERS_PAGE_SIZE
+        for chat_id in subscribers[start:start + self.USERS_PAGE_SIZE]:
+            lines.append(" " + chat_id)
+        if pages > 1:
+            lines.append("Use /users N to see page N.")
 
-        bot.send_message(chat_id=update.message.chat_id,
-                         text=send_string)
+        for part in split_message("\n".join(lines)):
+            self.reply(bot, update, part)
 
-    def broadcast(self, broadcast_text):
+    def fan_out(self, chat_ids, text, document=None):
         """
-        Broadcast the message via TELEGRAM.
-        Will do nothing is broadcast_text is empty.
-        :param broadcast_text: message to be broadcasted
-        :return: nothing
+        Send the message to the chats, every bot sending to its own chats at the same time.
+        :param chat_ids: chats to send the message to
+        :param text: message text, the caption if the message is a document
+        :param document: path to the document to send, None for a text message
+        :return: summary of the delivery, see Broadcaster.broadcast
         """
-        if not broadcast_text:
+        groups = {}
+        for chat_id in chat_ids:
+            groups.setdefault(self.shard_for_chat(chat_id), []).append(chat_id)
+
+        if len(groups) == 1:
+            shard, group = groups.popitem()
+            summary = shard.broadcaster.broadcast(group, text, document)
+        else:
+            summary = {'delivered': [], 'retried': [], 'failed': [], 'unreachable': []}
+            futures = [self.shard_executor.submit(shard.broadcaster.broadcast, group, text, document)
+                       for shard, group in groups.items()]
+            for future in futures:
+                for status, chats in future.result().items():
+                    summary[status].extend(chats)
+
+        for chat_id, quarantined, error in self.subscribers.record_delivery(summary, self.quarantine_after):
+            logging.warning("Chat %s is unreachable, quarantined: %s", chat_id, error)
+            METRICS.inc('sender_chats_quarantined_total')
+            self.quarantine_chat_id_in_database(self.store, chat_id, quarantined, error)
+        return summary
+
+    def ingest(self, text, dedup_key=None, source='tcp', received=None, priority=None, topic=None,
+               document=None):
+        """
+        Accept the message for the broadcast. The message is saved to the spool and will
+        be delivered by the delivery thread.
+        Will do nothing if text is empty, the priority is unknown, the topic is not valid,
+        the spool is full or the message is a repeat.
+        :param text: message to be broadcasted
+        :param dedup_key: deduplication key from the producer, None to use the text
+        :param source: where the message came from, for metrics
+        :param received: time the message was received (unix time), now if None
+        :param priority: priority name (see Spool.PRIORITIES), None for normal
+        :param topic: topic of the message, None to send it to all subscribers
+        :param document: path to the document in the document spool, None for a text message;
+                         the caller removes it if the message is not accepted
+        :return: INGEST_ACCEPTED, INGEST_EMPTY, INGEST_BAD_PRIORITY, INGEST_BAD_TOPIC, INGEST_BUSY
+                 or INGEST_DUPLICATE
+        """
+        if not text:
             logging.warning("Broadcast message is empty")
-            return
+            METRICS.inc('sender_messages_rejected_total', reason=self.INGEST_EMPTY)
+            return self.INGEST_EMPTY
+
+        priority = str(priority or 'normal').strip().lower()
+        if priority not in Spool.PRIORITIES:
+            logging.warning("Unknown priority %s, message rejected", priority)
+            METRICS.inc('sender_messages_rejected_total', reason=self.INGEST_BAD_PRIORITY)
+            return self.INGEST_BAD_PRIORITY
+        lane = Spool.PRIORITIES[priority]
+
+        if topic is not None:
+            topic = SubscriberRegistry.normalize_topic(topic)
+            if topic is None:
+                logging.warning("Bad topic, message rejected")
+                METRICS.inc('sender_messages_rejected_total', reason=self.INGEST_BAD_TOPIC)
+                return self.INGEST_BAD_TOPIC
+
+        if lane != Spool.PRIORITY_CRITICAL and self.spool.size() >= self.max_queue:
+            logging.warning("Spool is full, message rejected")
+            METRICS.inc('sender_messages_rejected_total', reason=self.INGEST_BUSY)
+            return self.INGEST_BUSY
+
+        if self.deduplicator and not self.deduplicator.check(text, dedup_key, topic):
+            logging.info("Message is a repeat, suppressed")
+            return self.INGEST_DUPLICATE
+
+        METRICS.inc('sender_messages_ingested_total', source=source, priority=priority)
+        self.enqueue(text, received, lane, topic, document)
+        return self.INGEST_ACCEPTED
+
+    def enqueue(self, text, received=None, priority=Spool.PRIORITY_NORMAL, topic=None, document=None):
+        """
+        Pass the accepted message to the coalescer, or directly to the spool.
+        Critical messages and documents are never held back by the coalescer. Text too long
+        for one message is saved as a document, with its beginning as the preview.
+        :param text: message text, the preview if the message is a document
+        :param received: time the message was received (unix time), now if None
+        :param priority: priority lane of the message
+        :param topic: topic of the message, None to send it to all subscribers
+        :param document: path to the document in the document spool, None for a text message
+        :return: nothing
+        """
+        if document is None and len(text) > MESSAGE_LIMIT:
+            document = self.documents.save(text)
+            text = make_preview(text, os.path.getsize(document))
 
-        for line in self.chat_ids:
-            self.updater.bot.send_message(chat_id=line,
-                                          text=broadcast_text)
+        if self.coalescer and priority != Spool.PRIORITY_CRITICAL and document is None:
+            self.coalescer.add(text, received, priority, topic)
+        else:
+            self.spool.append(text, received, priority, topic, document=document)
 
     def parse_arguments(self):
         """
@@ -410,20 +3955,41 @@ class Application:
         #pylint:disable=C0301
         parser = argparse.ArgumentParser(description="This bot will listen on specified port and will"
                                                      "broadcast all messages it receives on it to all"
-                                                     "users who are registered. Requires PostgreSQL "
-                                                     "database."
+                                                     "users who are registered. Keeps users in PostgreSQL "
+                                                     "or SQLite database."
                                                      ""
                                                      "And you need a secret word to register, by the way.",
                                          formatter_class=argparse.RawTextHelpFormatter)
 
         parser.add_argument("-v", "--version", action="store_true", default=False,
                             help="show version info")
-        parser.add_argument("token", default="", nargs='?',
-                            help="telegram bot token")
+        parser.add_argument("token", default=[], nargs='*',
+                            help="telegram bot token, several tokens to spread subscribers over several bots")
         parser.add_argument("--host", metavar="HOST", default=self.host,
                             help="host to listen on, default is " + str(self.host))
         parser.add_argument("--port", metavar="PORT", default=self.port,
                             help="port to listen on, default is " + str(self.port))
+        parser.add_argument("--max_connections", metavar="N", default=self.max_connections,
+                            help="maximum number of producer connections, default is " + str(self.max_connections))
+        parser.add_argument("--read_timeout", metavar="SEC", default=self.read_timeout,
+                            help="producer connection read timeout, default is " + str(self.read_timeout))
+        parser.add_argument("--max_message_size", metavar="BYTES", default=self.max_message_size,
+                            help="maximum framed message size, default is " + str(self.max_message_size))
+        parser.add_argument("--documents", metavar="PATH", default=self.documents_path,
+                            help="directory for long messages sent as documents, default is " + str(self.documents_path))
+        parser.add_argument("--max_document_size", metavar="BYTES", default=self.max_document_size,
+                            help="maximum message size on the TCP port, default is " + str(self.max_document_size))
+        parser.add_argument("--framed_port", metavar="PORT", default=self.framed_port,
+                            help="port for the framed JSON protocol, 0 to disable, default is " + str(self.framed_port))
+        parser.add_argument("--framed_idle_timeout", metavar="SEC", default=self.framed_idle_timeout,
+                            help="framed connection idle timeout, default is " + str(self.framed_idle_timeout))
+        parser.add_argument("--http_port", metavar="PORT", default=self.http_port,
+                            help="port for the HTTP ingest API, 0 to disable, default is " + str(self.http_port))
+        parser.add_argument("--http_max_body", metavar="BYTES", default=self.http_max_body,
+                            help="maximum HTTP request body, default is " + str(self.http_max_body))
+        parser.add_argument("--metrics_port", metavar="PORT", default=self.metrics_port,
+                            help="port for the Prometheus metrics endpoint, 0 to disable, default is " +
+                            str(self.metrics_port))
         parser.add_argument("--secret", metavar="WORD", default=self.secret_word,
                             help="secret word to register, default: " + str(self.secret_word))
         parser.add_argument("--db_host", metavar="DB_HOST", default=self.db_settings['db_host'],
@@ -436,6 +4002,58 @@ class Application:
                             help="database username, default is: " + str(self.db_settings['db_user']))
         parser.add_argument("--db_pass", metavar="PASS", default=self.db_settings['db_pass'],
                             help="database password, default is: " + str(self.db_settings['db_pass']))
+        parser.add_argument("--storage", choices=['postgres', 'sqlite'], default=self.storage,
+                            help="subscriber storage, default is: " + str(self.storage))
+        parser.add_argument("--sqlite_path", metavar="PATH", default=self.sqlite_path,
+                            help="SQLite database for --storage sqlite, default is: " + str(self.sqlite_path))
+        parser.add_argument("--db_pool_size", metavar="N", default=self.db_pool_size,
+                            help="database connection pool size, default is: " + str(self.db_pool_size))
+        parser.add_argument("--import", metavar="FILE", dest="import_file", default=None,
+                            help="import chat IDs from the file (one per line) to the database and exit")
+        parser.add_argument("--send_workers", metavar="N", default=self.send_workers,
+                            help="number of parallel sends during broadcast, default is " + str(self.send_workers))
+        parser.add_argument("--send_retries", metavar="N", default=self.send_retries,
+                            help="number of retries for the failed send, default is " + str(self.send_retries))
+        parser.add_argument("--global_rate", metavar="RATE", default=self.global_rate,
+                            help="maximum messages per second for the bot, default is " + str(self.global_rate))
+        parser.add_argument("--quarantine_after", metavar="N", default=self.quarantine_after,
+                            help="quarantine chats unreachable N deliveries in a row, 0 to disable, default is " +
+                            str(self.quarantine_after))
+        parser.add_argument("--sync_interval", metavar="SEC", default=self.sync_interval,
+                            help="seconds between reloads of subscribers changed by other instances (PostgreSQL only),\n"
+                                 "0 to disable the sync, default is " + str(self.sync_interval))
+        parser.add_argument("--drain_timeout", metavar="SEC", default=self.drain_timeout,
+                            help="seconds to deliver queued messages on shutdown, default is " + str(self.drain_timeout))
+        parser.add_argument("--spool", metavar="PATH", default=self.spool_path,
+                            help="outbound spool database, default is " + str(self.spool_path))
+        parser.add_argument("--queue", choices=['local', 'postgres', 'sqlite'], default=self.queue,
+                            help="where messages wait for delivery: local spool, or job queue shared by\n"
+                                 "several instances in PostgreSQL or SQLite, default is " + str(self.queue))
+        parser.add_argument("--queue_path", metavar="PATH", default=self.queue_path,
+                            help="SQLite database for --queue sqlite, default is " + str(self.queue_path))
+        parser.add_argument("--mode", choices=['all', 'ingest', 'worker'], default=self.mode,
+                            help="role of the instance: all, ingest (accept messages and commands) or\n"
+                                 "worker (deliver from the shared queue), default is " + str(self.mode))
+        parser.add_argument("--coalesce_window", metavar="SEC", default=self.coalesce_window,
+                            help="pack messages arriving within SEC seconds together, 0 to disable, default is " +
+                            str(self.coalesce_window))
+        parser.add_argument("--coalesce_max", metavar="N", default=self.coalesce_max,
+                            help="pack at most N messages at once, default is " + str(self.coalesce_max))
+        parser.add_argument("--dedup_window", metavar="SEC", default=self.dedup_window,
+                            help="suppress repeats of a message for SEC seconds, 0 to disable, default is " +
+                            str(self.dedup_window))
+        parser.add_argument("--dedup_size", metavar="N", default=self.dedup_size,
+                            help="remember at most N messages for suppression, default is " + str(self.dedup_size))
+        parser.add_argument("--max_queue", metavar="N", default=self.max_queue,
+                            help="maximum undelivered messages in the spool, default is " + str(self.max_queue))
+        parser.add_argument("--scheduling", choices=['weighted', 'strict'], default=self.scheduling,
+                            help="scheduling of the priority lanes, default is " + str(self.scheduling))
+        parser.add_argument("--lane_weights", metavar="C,N,B", default=",".join(str(weight) for weight in self.lane_weights),
+                            help="weights of critical, normal and bulk lanes, default is " +
+                            ",".join(str(weight) for weight in self.lane_weights))
+        parser.add_argument("--bulk_ttl", metavar="SEC", default=self.bulk_ttl,
+                            help="drop bulk messages not delivered within SEC seconds, 0 to disable, default is " +
+                            str(self.bulk_ttl))
         parser.add_argument("--verbose", default=self.verbose,
                             help=
                             "log verbose level, possible values:\r" +
@@ -453,8 +4071,10 @@ class Application:
             print(__version__)
             sys.exit(0)
 
-        if args.token:
-            self.token = args.token
+        if args.token or args.import_file:
+            self.tokens = args.token
+            self.token = args.token[0] if args.token else ''
+
         else:
             print("No source URL, station id or filename provided!")
             sys.exit(0)
@@ -462,11 +4082,52 @@ class Application:
         self.secret_word = args.secret
         self.host = args.host
         self.port = int(args.port)
+        self.max_connections = int(args.max_connections)
+        self.read_timeout = float(args.read_timeout)
+        self.max_message_size = int(args.max_message_size)
+        self.documents_path = args.documents
+        self.max_document_size = int(args.max_document_size)
+        self.framed_port = int(args.framed_port)
+        self.framed_idle_timeout = float(args.framed_idle_timeout)
+        self.metrics_port = int(args.metrics_port)
+        self.http_port = int(args.http_port)
+        self.http_max_body = int(args.http_max_body)
         self.db_settings['db_host'] = args.db_host
         self.db_settings['db_port'] = int(args.db_port)
         self.db_settings['db_name'] = args.db_name
         self.db_settings['db_user'] = args.db_user
         self.db_settings['db_pass'] = args.db_pass
+        self.db_pool_size = int(args.db_pool_size)
+        self.storage = args.storage
+        self.sqlite_path = args.sqlite_path
+        self.import_file = args.import_file
+        self.send_workers = int(args.send_workers)
+        self.send_retries = int(args.send_retries)
+        self.global_rate = float(args.global_rate)
+        self.quarantine_after = int(args.quarantine_after)
+        self.sync_interval = float(args.sync_interval)
+        self.drain_timeout = float(args.drain_timeout)
+        self.spool_path = args.spool
+        self.queue = args.queue
+        self.queue_path = args.queue_path
+        self.mode = args.mode
+        if self.mode != 'all' and self.queue == 'local':
+            print("--mode " + self.mode + " needs the shared queue, --queue postgres or sqlite!")
+            sys.exit(1)
+        if self.queue == 'postgres' and self.storage != 'postgres':
+            print("--queue postgres needs --storage postgres!")
+            sys.exit(1)
+        self.max_queue = int(args.max_queue)
+        self.scheduling = args.scheduling
+        self.lane_weights = [int(weight) for weight in args.lane_weights.split(",")]
+        if len(self.lane_weights) != 3 or min(self.lane_weights) < 1:
+            print("--lane_weights should be three positive numbers!")
+            sys.exit(1)
+        self.bulk_ttl = float(args.bulk_ttl)
+        self.coalesce_window = float(args.coalesce_window)
+        self.coalesce_max = int(args.coalesce_max)
+        self.dedup_window = float(args.dedup_window)
+        self.dedup_size = int(args.dedup_size)
 
         self.verbose = int(args.verbose)
 
@@ -492,15 +4153,198 @@ class Application:
                                 level=logging.ERROR)
 
         # Printing values on screen for debug
-        logging.debug("Token  : %s ", str(self.token))
+        logging.debug("Tokens : %s ", str(self.tokens))
         logging.debug("Host   : %s ", str(self.host))
         logging.debug("Port   : %s ", str(self.port))
+        logging.debug("Framed : %s ", str(self.framed_port))
+        logging.debug("Metrics: %s ", str(self.metrics_port))
+        logging.debug("HTTP   : %s ", str(self.http_port))
         logging.debug("Secret : %s ", str(self.secret_word))
+        logging.debug("STORAGE: %s", str(self.storage))
         logging.debug("DB_HOST: %s", str(self.db_settings['db_host']))
         logging.debug("DB_PORT: %s", str(self.db_settings['db_port']))
         logging.debug("DB_NAME: %s", str(self.db_settings['db_name']))
         logging.debug("DB_USER: %s", str(self.db_settings['db_user']))
         logging.debug("DB_PASS: %s", str(self.db_settings['db_pass']))
+        logging.debug("WORKERS: %s", str(self.send_workers))
+        logging.debug("RETRIES: %s", str(self.send_retries))
+        logging.debug("RATE   : %s", str(self.global_rate))
+        logging.debug("SPOOL  : %s", str(self.spool_path))
+        logging.debug("JOBS   : %s %s", str(self.queue), str(self.mode))
+        logging.debug("QUEUE  : %s", str(self.max_queue))
+        logging.debug("LANES  : %s %s", str(self.scheduling), str(self.lane_weights))
+        logging.debug("WINDOW : %s", str(self.coalesce_window))
+        logging.debug("DEDUP  : %s", str(self.dedup_window))
+        logging.debug("CONNS  : %s", str(self.max_connections))
+
+    def import_chat_ids(self):
+        """
+        Import chat IDs from the import file to the database.
+        :return: 0 if OK, error code if not
+        """
+        try:
+            with open(self.import_file) as import_file:
+                chat_ids = [line.strip() for line in import_file if line.strip()]
+        except Exception as e:
+            logging.error("Exception (import_chat_ids read): %s", str(e))
+            return 1
+
+        logging.info("Importing %d chat IDs from %s", len(chat_ids), self.import_file)
+        return self.save_chat_ids_to_database(self.store, chat_ids)
+
+    def setup_bot(self, base_url=None):
+        """
+        Create the Telegram updater, the rate limiter and the delivery engine for every bot.
+        :param base_url: Bot API base URL, None for the official one
+        :return: nothing
+        """
+        self.shards = [Shard(token,
+                             workers=self.send_workers,
+                             global_rate=self.global_rate,
+                             retries=self.send_retries,
+                             base_url=base_url)
+                       for token in (self.tokens or [self.token])]
+        self.shards_by_bot = {shard.bot_id: shard for shard in self.shards}
+        if len(self.shards) > 1:
+            self.shard_executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards))
+
+        self.updater = self.shards[0].updater
+        self.dispatcher = self.updater.dispatcher
+        self.sender = self.shards[0].sender
+        self.broadcaster = self.shards[0].broadcaster
+
+    def start_threads(self):
+        """
+        Open the spool and start delivery, ingest and metrics threads.
+        :return: nothing
+        """
+        self.threads = []
+        self.documents = DocumentSpool(self.documents_path, self.max_document_size)
+
+        # Opening the spool, messages left from the previous run will be delivered first
+        ttls = {Spool.PRIORITY_BULK: self.bulk_ttl} if self.bulk_ttl > 0 else None
+        if self.queue == 'postgres':
+            self.spool = PostgresJobQueue(self.db_settings, pool_size=self.db_pool_size, ttls=ttls)
+        elif self.queue == 'sqlite':
+            self.spool = SQLiteJobQueue(self.queue_path, self.subscribers.recipients, ttls=ttls)
+        else:
+            self.spool = Spool(self.spool_path, ttls=ttls)
+        try:
+            if isinstance(self.spool, PostgresJobQueue):
+                self.spool.migrate()
+            logging.info("Messages in the %s queue: %d", self.queue, self.spool.size())
+        except Exception as e:
+            logging.error("Exception (job queue migrate): %s", str(e))
+
+        # Start metrics server
+        if self.metrics_port:
+            METRICS.gauge('sender_spool_messages', self.spool.size)
+            METRICS.gauge('sender_subscribers', lambda: len(self.subscribers))
+            METRICS.gauge('sender_subscribers_quarantined', lambda: len(self.subscribers.quarantined()))
+            if isinstance(self.store, PostgresStore):
+                METRICS.gauge('sender_db_connections_in_use', lambda: self.store.db_pool.in_use)
+            METRICS.gauge('sender_coalescer_messages',
+                          lambda: len(self.coalescer.buffer) if self.coalescer else 0)
+            METRICS.gauge('sender_dedup_keys',
+                          lambda: self.deduplicator.stats()['keys'] if self.deduplicator else 0)
+            self.threads.append(MetricsServerThread(self))
+
+        # Start the sync of subscribers with other instances
+        if self.sync_interval > 0 and isinstance(self.store, PostgresStore):
+            self.threads.append(ChatSyncThread(self, self.sync_interval, self.sync_version))
+
+        # Start delivery
+        if self.mode != 'ingest':
+            self.threads.append(DeliveryThread(self,
+                                               strict=self.scheduling == 'strict',
+                                               weights={Spool.PRIORITY_CRITICAL: self.lane_weights[0],
+                                                        Spool.PRIORITY_NORMAL: self.lane_weights[1],
+                                                        Spool.PRIORITY_BULK: self.lane_weights[2]}))
+
+        # Workers only deliver, ingest is left to other instances
+        if self.mode == 'worker':
+            for thread in self.threads:
+                thread.daemon = True
+                thread.start()
+            return
+
+        # Start coalescing of bursts
+        if self.coalesce_window > 0:
+            self.coalescer = CoalescerThread(self, self.coalesce_window, self.coalesce_max)
+            self.threads.append(self.coalescer)
+
+        # Start suppression of repeats
+        if self.dedup_window > 0:
+            self.deduplicator = DeduplicatorThread(self, self.dedup_window, self.dedup_size)
+            self.threads.append(self.deduplicator)
+
+        # Start TCP Server
+        self.threads.append(TCPServerThread(self, self.port))
+
+        # Start TCP Server for the framed protocol
+        if self.framed_port:
+            self.threads.append(TCPServerThread(self, self.framed_port, FramedTCPRequestHandler))
+
+        # Start HTTP ingest API
+        if self.http_port:
+            self.threads.append(TCPServerThread(self, self.http_port, HTTPIngestRequestHandler))
+
+        # Daemons, threads stuck after the drain deadline do not keep the process alive
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def join_threads(self, deadline=None):
+        """
+        Stop the threads started by start_threads and close the spool. Ingest threads are
+        stopped first, then the messages left are delivered until the deadline. Messages
+        not delivered stay in the spool. Threads still running at the deadline are left behind.
+        :param deadline: time (time.monotonic) to stop delivering at, None to stop right away
+        :return: nothing
+        """
+        def join(thread):
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+        self.is_accepting = False
+        delivery = [thread for thread in self.threads
+                    if isinstance(thread, (DeliveryThread, MetricsServerThread, ChatSyncThread))]
+        for thread in reversed(self.threads):
+            if thread in delivery:
+                continue
+            join(thread)
+            # Nothing collected should be lost, producers are stopped by now
+            if thread is self.deduplicator:
+                self.deduplicator.flush()
+            elif thread is self.coalescer:
+                self.coalescer.flush()
+
+        # Shared queue is left to other instances, only the local spool is drained
+        while deadline is not None and self.is_running and self.queue == 'local' and \
+                self.spool.size() and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        self.is_running = False
+        for shard in self.shards:
+            shard.broadcaster.cancel()
+        for thread in delivery:
+            join(thread)
+        left = self.spool.size()
+        if left and self.queue == 'local':
+            logging.warning("%d messages left in the spool, they will be delivered on the next start", left)
+        elif left:
+            logging.info("%d messages left in the shared queue", left)
+
+        # Closing the spool under a running thread is not safe, the exit closes it anyway
+        stuck = [thread.name for thread in self.threads if thread.is_alive()]
+        if stuck:
+            logging.warning("Threads did not stop until the deadline: %s", ", ".join(stuck))
+            return
+
+        for shard in self.shards:
+            shard.broadcaster.stop()
+        if self.shard_executor:
+            self.shard_executor.shutdown(wait=True)
+        self.spool.close()
 
     def run(self):
         """
@@ -513,62 +4357,123 @@ class Application:
         self.parse_arguments()
         logging.info("API library version: %s", str(TELEGRAM_API_VERSION))
 
+        try:
+            if self.storage == 'sqlite':
+                self.store = SQLiteStore(self.sqlite_path)
+            else:
+                self.store = PostgresStore(self.db_settings, pool_size=self.db_pool_size)
+        except Exception as e:
+            logging.critical("Failed to open the subscriber storage, error: %s", str(e))
+            sys.exit(1)
+
+        # Importing Chat IDs, if asked to
+        if self.import_file:
+            result = self.import_chat_ids()
+            self.store.close()
+            sys.exit(result)
+
         # Loading Chat IDs from Database
         logging.info("Loading chat ID's from Database...")
-        self.chat_ids = self.load_chat_ids_from_database(self.db_settings)
+        try:
+            self.store.migrate()
+        except Exception as e:
+            logging.error("Exception (migrate): %s", str(e))
+            logging.error("Updating the schema needs the owner of the tables, see database.txt")
+        if self.sync_interval > 0 and isinstance(self.store, PostgresStore):
+            # Taken before loading, changes made meanwhile are applied again by the sync
+            try:
+                self.sync_version = self.store.version()
+            except Exception as e:
+                logging.error("Exception (chats version query): %s", str(e))
+        # Running with no subscribers would silently drop every message
+        chat_ids = self.load_chat_ids_from_database(self.store)
+        topics = self.load_topics_from_database(self.store)
+        if chat_ids is None or topics is None:
+            logging.critical("Failed to load subscribers from the database, exiting")
+            self.store.close()
+            sys.exit(1)
+        self.subscribers = SubscriberRegistry()
+        for chat_id, bot_id, quarantined, last_error in chat_ids:
+            self.subscribers.add(chat_id, bot_id=bot_id, quarantined=quarantined, last_error=last_error)
+        for chat_id, topic in topics:
+            self.subscribers.subscribe(chat_id, topic)
         if self.print_users_from_db:
             print()
             print("Users:")
-            for chat_id in self.chat_ids:
+            for chat_id in self.subscribers.snapshot():
                 print(" " + str(chat_id))
             print()
 
         # Setting the bot up
-        self.updater = Updater(token=self.token)
-        self.dispatcher = self.updater.dispatcher
+        self.setup_bot()
 
-        # Command: /start
-        start_handler = CommandHandler('start', self.start)
-        self.dispatcher.add_handler(start_handler)
+        # Chats registered before several bots were supported, or imported, belong to the first bot
+        assigned = self.subscribers.assign_bot(self.shards[0].bot_id)
+        if assigned:
+            logging.info("%d chats without a bot are served by the first one", assigned)
+            self.assign_bot_in_database(self.store, self.shards[0].bot_id)
 
-        # Command: /forget
-        forget_handler = CommandHandler('forget', self.forget)
-        self.dispatcher.add_handler(forget_handler)
+        # Workers neither poll nor answer the commands
+        shards = self.shards if self.mode != 'worker' else []
+        for shard in shards:
+            dispatcher = shard.updater.dispatcher
 
-        # Command: /register
-        register_handler = CommandHandler('register:' + self.secret_word, self.register)
-        self.dispatcher.add_handler(register_handler)
+            # Command: /start
+            start_handler = CommandHandler('start', self.start)
+            dispatcher.add_handler(start_handler)
 
-        # Command: /users
-        users_handler = CommandHandler('users', self.users)
-        self.dispatcher.add_handler(users_handler)
+            # Command: /forget
+            forget_handler = CommandHandler('forget', self.forget)
+            dispatcher.add_handler(forget_handler)
 
-        # Broadcasting the message that bot is up and running
-        try:
-            logging.info("Broadcasting the message now")
-            if self.updater:
-                self.broadcast("Bot is up and running!")
-        except Exception as e:
-            logging.error("Failed to broadcast a message!")
-            logging.error(str(e))
+            # Command: /register
+            register_handler = CommandHandler('register:' + self.secret_word, self.register)
+            dispatcher.add_handler(register_handler)
 
-        # Start TCP Server
-        tcp_server_thread = TCPServerThread(self)
-        tcp_server_thread.start()
+            # Command: /users
+            users_handler = CommandHandler('users', self.users, pass_args=True)
+            dispatcher.add_handler(users_handler)
+
+            # Command: /quarantine
+            quarantine_handler = CommandHandler('quarantine', self.quarantine, pass_args=True)
+            dispatcher.add_handler(quarantine_handler)
+
+            # Command: /subscribe
+            subscribe_handler = CommandHandler('subscribe', self.subscribe, pass_args=True)
+            dispatcher.add_handler(subscribe_handler)
+
+            # Command: /unsubscribe
+            unsubscribe_handler = CommandHandler('unsubscribe', self.unsubscribe, pass_args=True)
+            dispatcher.add_handler(unsubscribe_handler)
+
+        # Start delivery and servers
+        self.start_threads()
+
+        # Broadcasting the message that bot is up and running, ahead of other messages.
+        # Instances sharing the job queue come and go, the others keep serving
+        if self.mode == 'all' and self.queue == 'local':
+            try:
+                logging.info("Broadcasting the message now")
+                self.spool.append("Bot is up and running!", priority=Spool.PRIORITY_CRITICAL)
+            except Exception as e:
+                logging.error("Failed to broadcast a message!")
+                logging.error(str(e))
 
         # Start polling
         logging.info("Start polling")
-        self.updater.start_polling(timeout=500)
-        logging.info("Polling started, write 'q' to exit.")
-        while self.is_running:
-            cmd = input().strip()
-            if cmd == 'q':
-                logging.info("Terminating the program!")
-                self.shutdown()
-                self.is_running = False
-            time.sleep(0.01)
+        for shard in shards:
+            shard.updater.start_polling(timeout=self.POLL_TIMEOUT)
+        if sys.stdin is not None and sys.stdin.isatty():
+            ConsoleThread(self).start()
+            logging.info("Polling started, write 'q' or send SIGTERM to exit.")
+        else:
+            logging.info("Polling started, send SIGTERM to exit.")
 
-        tcp_server_thread.join()
+        # Signal handlers only request the shutdown, it is done here
+        while not self.stop_requested.wait(1):
+            pass
+        self.shutdown()
+        self.store.close()
 
         logging.info("Application terminated!")
 